@@ -0,0 +1,159 @@
+import os
+import json
+import argparse
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+
+from database_manager import DatabaseManager
+from detection_policy import DetectionPolicy
+from frame_sources import open_capture
+from gallery_store import DEFAULT_GALLERY_FILE
+from recognition_engine import RecognitionEngine, load_matcher
+
+DEFAULT_SAMPLE_FPS = 2.0
+DEFAULT_SEGMENT_SECONDS = 300.0
+
+# One engine per worker process, so the gallery is loaded once per process, not per segment
+_engine = None
+
+def _init_worker(gallery_file):
+    global _engine
+    _engine = RecognitionEngine(gallery_file, matcher=load_matcher(gallery_file, migrate=False))
+
+def plan_segments(video, segment_seconds):
+    # Splits a video into [start, end) time ranges, in seconds
+    capture = open_capture(video)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    duration = capture.get(cv2.CAP_PROP_FRAME_COUNT) / fps
+    capture.release()
+
+    segments = []
+    start = 0.0
+    while start < duration:
+        end = min(start + segment_seconds, duration)
+        segments.append((video, start, end))
+        start = end
+    return segments, duration
+
+def process_segment(segment, sample_fps):
+    """
+    Runs recognition over one time range of a video, sampling sample_fps frames a second.
+    Returns {identity: [first_seen, last_seen]} with times in seconds from the start of the video.
+    """
+    video, start, end = segment
+    # Segments are unrelated to whatever this worker processed before
+    _engine.detection_policy = DetectionPolicy()
+    _engine.reset()
+
+    capture = open_capture(video)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    step = max(1, int(round(fps / sample_fps)))
+    capture.set(cv2.CAP_PROP_POS_MSEC, start * 1000.0)
+
+    seen = {}
+    frame_number = 0
+    while True:
+        # grab() skips frames without decoding them; only sampled frames are decoded
+        if not capture.grab():
+            break
+        timestamp = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        if timestamp >= end:
+            break
+        frame_number += 1
+        if (frame_number - 1) % step:
+            continue
+
+        ret, frame = capture.retrieve()
+        if not ret:
+            break
+        for event in _engine.process(frame, timestamp) or []:
+            if event.identity == "Unknown":
+                continue
+            first_last = seen.setdefault(event.identity, [timestamp, timestamp])
+            first_last[0] = min(first_last[0], timestamp)
+            first_last[1] = max(first_last[1], timestamp)
+
+    capture.release()
+    return seen
+
+def _process_segment_job(job):
+    segment, sample_fps = job
+    return segment, process_segment(segment, sample_fps)
+
+def recording_start(video, duration):
+    # Cameras write the file as they record, so its mtime marks the end of the recording
+    return datetime.fromtimestamp(os.path.getmtime(video)) - timedelta(seconds=duration)
+
+def run_batch(videos, gallery_file=DEFAULT_GALLERY_FILE, sample_fps=DEFAULT_SAMPLE_FPS,
+              segment_seconds=DEFAULT_SEGMENT_SECONDS, workers=None, start_times=None):
+    """
+    Processes the videos in parallel segments.
+    Returns {identity: {"first_seen": datetime, "last_seen": datetime, "video": path}}.
+    """
+    segments = []
+    starts = {}
+    for video in videos:
+        video_segments, duration = plan_segments(video, segment_seconds)
+        segments.extend(video_segments)
+        starts[video] = (start_times or {}).get(video) or recording_start(video, duration)
+
+    # Imports an old encodings.pickle here, once, rather than in every worker at the same time
+    load_matcher(gallery_file)
+
+    print(f"[INFO] Processing {len(videos)} video(s) in {len(segments)} segment(s)...")
+    jobs = [(segment, sample_fps) for segment in segments]
+    workers = workers or os.cpu_count() or 1
+
+    summary = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(gallery_file,)) as executor:
+        for done, (segment, seen) in enumerate(executor.map(_process_segment_job, jobs), 1):
+            video = segment[0]
+            print(f"[INFO] Segment {done}/{len(segments)} done ({os.path.basename(video)} {segment[1]:.0f}s-{segment[2]:.0f}s)")
+            for identity, (first, last) in seen.items():
+                first = starts[video] + timedelta(seconds=first)
+                last = starts[video] + timedelta(seconds=last)
+                entry = summary.setdefault(identity, {"first_seen": first, "last_seen": last, "video": video})
+                if first < entry["first_seen"]:
+                    entry["first_seen"] = first
+                    entry["video"] = video
+                entry["last_seen"] = max(entry["last_seen"], last)
+    return summary
+
+def record_attendance(summary, db):
+    # Marks every recognized student present on the day (and at the time) they were first seen
+    marked = []
+    for identity, entry in sorted(summary.items()):
+        user_id = identity.split('_')[0]
+        if db.users.role_of(user_id) != "Student":
+            continue
+        first_seen = entry["first_seen"]
+        if db.mark_attendance(user_id, date_str=first_seen.strftime("%Y-%m-%d"), time_str=first_seen.strftime("%H:%M:%S")):
+            marked.append(user_id)
+    return marked
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute attendance from recorded lecture videos.")
+    parser.add_argument("videos", nargs="+", help="video files to process")
+    parser.add_argument("--gallery", default=DEFAULT_GALLERY_FILE, help="gallery file to match against")
+    parser.add_argument("--sample-fps", type=float, default=DEFAULT_SAMPLE_FPS, help="frames analysed per second of video")
+    parser.add_argument("--segment-seconds", type=float, default=DEFAULT_SEGMENT_SECONDS, help="length of the pieces processed in parallel")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: one per core)")
+    parser.add_argument("--start", default=None, help="recording start as 'YYYY-MM-DD HH:MM:SS' (default: file time minus duration)")
+    parser.add_argument("--dry-run", action="store_true", help="print the results without writing attendance")
+    args = parser.parse_args()
+
+    start_times = None
+    if args.start:
+        start = datetime.strptime(args.start, "%Y-%m-%d %H:%M:%S")
+        start_times = {video: start for video in args.videos}
+
+    summary = run_batch(args.videos, args.gallery, args.sample_fps, args.segment_seconds, args.workers, start_times)
+    print(json.dumps({
+        identity: {"first_seen": str(entry["first_seen"]), "last_seen": str(entry["last_seen"]), "video": entry["video"]}
+        for identity, entry in sorted(summary.items())
+    }, indent=2))
+
+    if not args.dry_run:
+        marked = record_attendance(summary, DatabaseManager())
+        print(f"[INFO] Marked {len(marked)} student(s) present.")
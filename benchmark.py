@@ -0,0 +1,346 @@
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import tempfile
+from contextlib import contextmanager
+from datetime import date, timedelta
+import numpy as np
+import cv2
+import face_recognition
+
+import encoder
+from database_manager import DatabaseManager, close_connection
+from face_matcher import FaceMatcher, build_prototype_index
+from frame_sources import iter_frames
+from gallery_store import load_gallery, write_gallery
+from recognition_engine import RecognitionEngine
+
+BASELINE_FILE = "benchmark_baseline.json"
+SUITES = ("encoder", "recognition", "database")
+
+DEFAULT_GALLERY_SIZES = (100, 1000, 10000)
+IMAGES_PER_IDENTITY = 5   # Encodings per synthetic identity, as after a short enrollment
+DEFAULT_REPEAT = 20
+DEFAULT_TOLERANCE = 0.2   # A median more than 20% slower than the baseline is a regression
+
+FRAME_SIZE = (640, 480)
+
+def measure(fn, repeat=DEFAULT_REPEAT, warmup=1):
+    """
+    Calls fn() warmup + repeat times. Returns timing stats in milliseconds over the timed calls.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000.0)
+    times = np.array(times)
+    return {
+        "median_ms": round(float(np.median(times)), 4),
+        "p95_ms": round(float(np.percentile(times, 95)), 4),
+        "min_ms": round(float(times.min()), 4),
+        "runs": repeat,
+    }
+
+@contextmanager
+def quiet():
+    # The code under test prints progress; keep it out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+# --- Encoder ---
+def bench_encoder(workdir, dataset, repeat):
+    """
+    Times Encoder.encode_faces on a copy of the dataset: a full run, serial and parallel,
+    and an incremental run with nothing to do.
+    """
+    dataset_copy = os.path.join(workdir, "dataset")
+    shutil.copytree(dataset, dataset_copy)
+    saved = (encoder.DATASET_PATH, encoder.ENCODINGS_FILE, encoder.MANIFEST_FILE)
+    encoder.DATASET_PATH = dataset_copy
+    encoder.ENCODINGS_FILE = os.path.join(workdir, "encodings.gallery")
+    encoder.MANIFEST_FILE = os.path.join(workdir, "encodings.manifest.json")
+
+    images = len(encoder.Encoder()._list_images())
+    runs = max(1, repeat // 10) # A full encode takes seconds; a few runs are enough
+    results = {}
+    try:
+        with quiet():
+            enc = encoder.Encoder()
+            results["encoder.full.serial"] = measure(lambda: enc.encode_faces(workers=1), runs, warmup=0)
+            results["encoder.full.parallel"] = measure(lambda: enc.encode_faces(), runs, warmup=0)
+            results["encoder.incremental.unchanged"] = measure(lambda: enc.encode_faces(incremental=True), repeat)
+    finally:
+        encoder.DATASET_PATH, encoder.ENCODINGS_FILE, encoder.MANIFEST_FILE = saved
+    for stats in results.values():
+        stats["images"] = images
+    return results
+
+# --- Recognition ---
+def synthetic_gallery(path, identities, per_identity=IMAGES_PER_IDENTITY, seed=0):
+    # Identities are random points on the embedding scale; their images scatter closely around them
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0.0, 0.1, size=(identities, 128))
+    encodings = np.repeat(centers, per_identity, axis=0) + rng.normal(0.0, 0.02, size=(identities * per_identity, 128))
+    names = [f"{i // per_identity:05d}_synthetic" for i in range(identities * per_identity)]
+    write_gallery(path, encodings, names, index=build_prototype_index(encodings, names))
+    return centers
+
+def load_frames(source, limit):
+    """
+    Frames to run recognition on: from a video, folder or webcam index if given,
+    else the dataset images scaled onto a frame-sized canvas.
+    """
+    frames = []
+    if source is not None:
+        for _, frame in iter_frames(source):
+            frames.append(frame)
+            if len(frames) >= limit:
+                break
+        return frames
+
+    width, height = FRAME_SIZE
+    for path in encoder.Encoder()._list_images()[:limit]:
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        scale = min(width / image.shape[1], height / image.shape[0])
+        image = cv2.resize(image, (0, 0), fx=scale, fy=scale)
+        frame = np.zeros((height, width, 3), np.uint8)
+        frame[:image.shape[0], :image.shape[1]] = image
+        frames.append(frame)
+    return frames
+
+def bench_recognition(workdir, frames, gallery_sizes, repeat):
+    """
+    Times the stages of RecognitionEngine.process (detection, embedding, matching) and the
+    whole call, per frame, against synthetic galleries of each size.
+    """
+    results = {}
+    rgb_frames = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in frames]
+    locations = [face_recognition.face_locations(rgb) for rgb in rgb_frames]
+    faces = sum(len(boxes) for boxes in locations)
+
+    counter = iter(range(1 << 62))
+    def next_frame():
+        return next(counter) % len(frames)
+
+    def detect():
+        i = next_frame()
+        face_recognition.face_locations(rgb_frames[i])
+    results["recognition.detect"] = measure(detect, repeat)
+    results["recognition.detect"]["faces"] = faces
+
+    def embed():
+        i = next_frame()
+        face_recognition.face_encodings(rgb_frames[i], locations[i])
+    results["recognition.embed"] = measure(embed, repeat)
+
+    for size in gallery_sizes:
+        gallery_file = os.path.join(workdir, f"synthetic_{size}.gallery")
+        centers = synthetic_gallery(gallery_file, size)
+        matcher = FaceMatcher.from_gallery(load_gallery(gallery_file))
+        queries = centers[:10] + np.random.default_rng(1).normal(0.0, 0.02, size=(min(10, size), 128))
+
+        results[f"recognition.match.{size}.faces1"] = measure(lambda: matcher.match(queries[:1]), repeat)
+        results[f"recognition.match.{size}.faces10"] = measure(lambda: matcher.match(queries), repeat)
+
+        with quiet():
+            engine = RecognitionEngine(gallery_file)
+        def process_cold():
+            # Fresh tracks: every face is detected, embedded and matched, like a new arrival
+            engine.reset()
+            engine.detect_next = True
+            engine.process(frames[next_frame()], 0.0)
+        results[f"recognition.process.{size}.cold"] = measure(process_cold, repeat)
+
+        engine.reset()
+        frame_index = iter(range(1 << 62))
+        def process_steady():
+            # Successive frames as the camera delivers them; tracks carry identities between frames
+            engine.process(frames[next(frame_index) % len(frames)], time.time())
+        results[f"recognition.process.{size}.steady"] = measure(process_steady, repeat)
+    return results
+
+# --- Database ---
+def synthetic_database(path, students, years, presence=0.8, seed=0):
+    # A term-time school year of ~200 class days, `students` students present with probability `presence`
+    rng = random.Random(seed)
+    with quiet():
+        db = DatabaseManager(path)
+    conn = db._conn()
+    day = date.today() - timedelta(days=365 * years)
+    days = []
+    while day < date.today():
+        if day.weekday() < 5 and rng.random() < 0.8:
+            days.append(day.strftime("%Y-%m-%d"))
+        day += timedelta(days=1)
+
+    ids = [f"S{i:05d}" for i in range(students)]
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (id, name, role, email_student, email_parent) VALUES (?, ?, 'Student', ?, ?)",
+            [(uid, f"Student {uid}", f"{uid}@example.com", f"parent.{uid}@example.com") for uid in ids],
+        )
+        conn.executemany("INSERT INTO sessions (date, started_at) VALUES (?, '09:00:00')", [(d,) for d in days])
+        conn.executemany(
+            "INSERT INTO attendance (user_id, date, time, status) VALUES (?, ?, '09:05:00', 'Present')",
+            ((uid, d) for d in days for uid in ids if rng.random() < presence),
+        )
+    rows = conn.execute("SELECT COUNT(*) FROM attendance").fetchone()[0]
+    db.users.reload()
+    return db, ids, days, rows
+
+def bench_database(workdir, students, years, repeat):
+    """
+    Times the DatabaseManager calls made on the kiosk's hot paths against a database
+    holding `years` of attendance for `students` students.
+    """
+    path = os.path.join(workdir, "benchmark.db")
+    db, ids, days, rows = synthetic_database(path, students, years)
+    results = {}
+
+    results["database.check_attendance_today"] = measure(
+        lambda: db.check_attendance_today(random.choice(ids), days[-1]), repeat * 10)
+
+    # New day, so every call inserts
+    new_day = (date.today() + timedelta(days=1)).strftime("%Y-%m-%d")
+    unmarked = iter(ids)
+    results["database.mark_attendance"] = measure(
+        lambda: db.mark_attendance(next(unmarked), date_str=new_day), min(repeat * 10, len(ids) - 1))
+
+    bulk_days = iter(range(2, 1 << 30))
+    def mark_bulk():
+        day = (date.today() + timedelta(days=next(bulk_days))).strftime("%Y-%m-%d")
+        db.mark_attendance_bulk(ids, date_str=day)
+    results["database.mark_attendance_bulk"] = measure(mark_bulk, max(1, repeat // 4))
+
+    def stats_uncached():
+        db._invalidate_stats()
+        db.get_attendance_stats()
+    results["database.get_attendance_stats.uncached"] = measure(stats_uncached, repeat)
+    results["database.get_attendance_stats.cached"] = measure(db.get_attendance_stats, repeat * 10)
+
+    def stats_page():
+        # One dashboard page over the last month, as the class dashboard loads it
+        db._invalidate_stats()
+        db.get_attendance_stats(days[-30], days[-1], limit=50)
+    results["database.get_attendance_stats.page"] = measure(stats_page, repeat)
+
+    for stats in results.values():
+        stats.update(students=students, attendance_rows=rows)
+    close_connection(path)
+    return results
+
+# --- Report ---
+def compare(results, baseline, tolerance):
+    """
+    Adds "baseline_median_ms" and "ratio" to each result found in the baseline.
+    Returns the names of results whose median got slower than the baseline by more than tolerance.
+    """
+    regressions = []
+    for name, stats in results.items():
+        base = baseline.get(name)
+        if not base or not base.get("median_ms"):
+            continue
+        stats["baseline_median_ms"] = base["median_ms"]
+        stats["ratio"] = round(stats["median_ms"] / base["median_ms"], 3)
+        if stats["ratio"] > 1.0 + tolerance:
+            regressions.append(name)
+    return regressions
+
+def print_report(results, regressions):
+    for name, stats in sorted(results.items()):
+        line = f"{name:<45} median {stats['median_ms']:>10.3f} ms   p95 {stats['p95_ms']:>10.3f} ms"
+        if "ratio" in stats:
+            line += f"   x{stats['ratio']:.2f} vs baseline"
+        if name in regressions:
+            line += "   REGRESSION"
+        print(line, file=sys.stderr)
+
+def run(suites, frames_source=None, gallery_sizes=DEFAULT_GALLERY_SIZES, students=500, years=3,
+        repeat=DEFAULT_REPEAT, frame_limit=20):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="smartguard-bench-")
+    try:
+        if "encoder" in suites:
+            print("[INFO] Benchmarking encoder...", file=sys.stderr)
+            results.update(bench_encoder(workdir, encoder.DATASET_PATH, repeat))
+        if "recognition" in suites:
+            print("[INFO] Benchmarking recognition...", file=sys.stderr)
+            frames = load_frames(frames_source, frame_limit)
+            if frames:
+                results.update(bench_recognition(workdir, frames, gallery_sizes, repeat))
+            else:
+                print("[WARN] No frames to benchmark recognition on.", file=sys.stderr)
+        if "database" in suites:
+            print("[INFO] Benchmarking database...", file=sys.stderr)
+            results.update(bench_database(workdir, students, years, repeat))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the encoder, recognition and database hot paths (no webcam or GUI needed).")
+    parser.add_argument("--suite", action="append", choices=SUITES, help="suite to run; repeat for several (default: all)")
+    parser.add_argument("--frames", default=None, help="video file or image folder to recognize (default: dataset images)")
+    parser.add_argument("--gallery-sizes", default=",".join(map(str, DEFAULT_GALLERY_SIZES)), help="comma-separated synthetic gallery sizes, in identities")
+    parser.add_argument("--students", type=int, default=500, help="students in the synthetic database")
+    parser.add_argument("--years", type=int, default=3, help="years of attendance in the synthetic database")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="timed runs per benchmark")
+    parser.add_argument("--output", default="-", help="JSON file to write the results to ('-' for stdout)")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="results of an earlier run to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed slowdown before a result counts as a regression")
+    args = parser.parse_args()
+
+    results = run(
+        args.suite or SUITES, args.frames, [int(size) for size in args.gallery_sizes.split(",") if size],
+        args.students, args.years, args.repeat,
+    )
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+        },
+        "results": results,
+        "regressions": regressions,
+    }
+    print_report(results, regressions)
+
+    text = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(text)
+        print(f"[INFO] Baseline saved to {args.baseline}.", file=sys.stderr)
+
+    # Non-zero exit so a deployment script can stop on a regression
+    sys.exit(1 if regressions else 0)
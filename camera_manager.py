@@ -0,0 +1,132 @@
+import sys
+import time
+import threading
+
+import metrics
+from camera_service import CameraService
+from gallery_store import DEFAULT_GALLERY_FILE
+from recognition_engine import load_matcher
+
+# A person seen again (by any camera) within this many seconds is reported only once
+DEDUP_SECONDS = 2.0
+
+class CameraManager:
+    """
+    Runs several cameras (webcam indexes, video files, stream URLs) against one gallery.
+    - The gallery is loaded once and its matcher shared by every camera; each camera keeps
+      only its own tracks and detection state.
+    - One scheduler thread does the recognition for all cameras. It takes the camera whose
+      turn is due first (round robin when all are busy), and a camera with an FPS budget
+      is not recognized more often than that, so no feed can starve the others.
+    - A person seen by several cameras, or on consecutive frames, reaches
+      detection_callback once per DEDUP_SECONDS.
+    The first camera is the primary one: the app previews it and enrolls with it.
+    """
+    def __init__(self, sources=(0,), encodings_file=DEFAULT_GALLERY_FILE, detection_callback=None,
+                 fps_budgets=None, dedup_seconds=DEDUP_SECONDS, workers=0):
+        self.encodings_file = encodings_file
+        self.detection_callback = detection_callback
+        self.dedup_seconds = dedup_seconds
+        # fps_budgets: one value for every camera or a list per camera; None means as fast as possible
+        if fps_budgets is None or isinstance(fps_budgets, (int, float)):
+            fps_budgets = [fps_budgets] * len(sources)
+        self.fps_budgets = list(fps_budgets)
+
+        self.frame_ready = threading.Condition() # Notified by every camera's grabber
+        self.is_running = False
+        self.last_reported = {} # {identity: time reported}
+        self.report_lock = threading.Lock()
+
+        matcher = load_matcher(encodings_file)
+        if workers and len(sources) > 1:
+            print("[WARN] Recognition workers are only used with a single camera.", file=sys.stderr)
+        self.cameras = []
+        for i, source in enumerate(sources):
+            camera = CameraService(
+                encodings_file, self._on_detection, workers=workers if len(sources) == 1 else 0,
+                # The primary camera faces the kiosk user and is mirrored; the others show the room as is
+                source=source, name=f"camera{i}", mirror=(i == 0), matcher=matcher,
+                scheduled=not workers or len(sources) > 1,
+            )
+            camera.frame_ready = self.frame_ready
+            # Only the primary camera is shown
+            camera.set_display_enabled(i == 0)
+            self.cameras.append(camera)
+
+        self.next_due = [0.0] * len(self.cameras)
+        self.busy_seconds = [0.0] * len(self.cameras)
+        for i, camera in enumerate(self.cameras):
+            metrics.gauge(f"{camera.name}.recognition_share", lambda i=i: self._share(i))
+
+    @property
+    def primary(self):
+        return self.cameras[0]
+
+    def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        for camera in self.cameras:
+            camera.start()
+        if any(camera.scheduled for camera in self.cameras):
+            threading.Thread(target=self._schedule_loop, daemon=True).start()
+
+    def stop(self):
+        self.is_running = False
+        for camera in self.cameras:
+            camera.stop()
+
+    def load_encodings(self):
+        # One load for all cameras
+        matcher = load_matcher(self.encodings_file)
+        for camera in self.cameras:
+            camera.engine.set_matcher(matcher)
+            if camera.pool:
+                camera.pool.reload_gallery()
+
+    def _schedule_loop(self):
+        cameras = [(i, camera) for i, camera in enumerate(self.cameras) if camera.scheduled]
+        while self.is_running:
+            now = time.monotonic()
+            with self.frame_ready:
+                waiting = [(i, camera) for i, camera in cameras if camera.latest_seq != camera.processed_seq]
+                due = [(i, camera) for i, camera in waiting if self.next_due[i] <= now]
+                if not due:
+                    # Sleep until a new frame arrives or a budgeted camera's turn comes
+                    timeout = min((self.next_due[i] - now for i, _ in waiting), default=0.1)
+                    self.frame_ready.wait(max(0.001, timeout))
+                    continue
+                # Earliest turn first; a camera that was just served goes to the back
+                i, camera = min(due, key=lambda entry: self.next_due[entry[0]])
+                frame = camera.take_frame()
+
+            started = time.perf_counter()
+            camera.recognize(frame)
+            self.busy_seconds[i] += time.perf_counter() - started
+
+            budget = self.fps_budgets[i]
+            self.next_due[i] = time.monotonic() + (1.0 / budget if budget else 0.0)
+
+    def _share(self, i):
+        # Fraction of the scheduler's recognition time spent on camera i
+        total = sum(self.busy_seconds)
+        return round(self.busy_seconds[i] / total, 3) if total else 0.0
+
+    def _on_detection(self, name):
+        # Called by every camera, for every tracked face on every recognized frame
+        if name != "Unknown":
+            now = time.monotonic()
+            with self.report_lock:
+                last = self.last_reported.get(name)
+                if last is not None and now - last < self.dedup_seconds:
+                    return
+                self.last_reported[name] = now
+        if self.detection_callback:
+            self.detection_callback(name)
+
+    def get_stats(self):
+        stats = {}
+        for i, camera in enumerate(self.cameras):
+            stats[camera.name] = dict(camera.get_stats(), source=str(camera.source),
+                                      fps_budget=self.fps_budgets[i], recognition_share=self._share(i))
+        return stats
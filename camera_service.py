@@ -1,118 +1,301 @@
+import os
 import cv2
-import face_recognition
-import pickle
 import threading
 import time
-import os
-from PIL import Image, ImageTk
+import numpy as np
+from collections import deque
+
+import metrics
+from enrollment import EnrollmentSession
+from frame_sources import is_live, open_capture
+from gallery_store import DEFAULT_GALLERY_FILE
+from recognition_engine import RecognitionEngine
+from recognition_pool import RecognitionPool
+
+class FpsCounter:
+    """
+    Frames per second over a sliding window of recent ticks.
+    """
+    def __init__(self, window=2.0):
+        self.window = window
+        self.ticks = deque()
+        self.lock = threading.Lock()
+
+    def tick(self):
+        now = time.monotonic()
+        with self.lock:
+            self.ticks.append(now)
+            while self.ticks and now - self.ticks[0] > self.window:
+                self.ticks.popleft()
+
+    def fps(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.ticks and now - self.ticks[0] > self.window:
+                self.ticks.popleft()
+            if len(self.ticks) < 2:
+                return 0.0
+            return (len(self.ticks) - 1) / (self.ticks[-1] - self.ticks[0])
+
+# Size of the preview shown on the Home page
+DISPLAY_SIZE = (640, 480)
 
 class CameraService:
-    def __init__(self, encodings_file="encodings.pickle", detection_callback=None):
+    """
+    One camera: grabs frames, recognizes faces on them and prepares the preview.
+    source is a webcam index, video file or stream URL. A CameraManager running several
+    cameras passes scheduled=True and a shared matcher; it then feeds frames to
+    recognize() itself instead of this service running its own recognition thread.
+    """
+    def __init__(self, encodings_file=DEFAULT_GALLERY_FILE, detection_callback=None, workers=0,
+                 source=0, name="camera", mirror=True, matcher=None, scheduled=False):
         self.video_capture = None
+        self.source = source
+        self.name = name
+        self.mirror = mirror
+        self.scheduled = scheduled
         self.is_running = False
         self.mode = "attendance" # 'attendance' or 'capture'
         self.encodings_file = encodings_file
         self.detection_callback = detection_callback
-        
-        self.known_face_encodings = []
-        self.known_face_names = []
-        self.load_encodings()
 
-        self.current_frame = None
         self.lock = threading.Lock()
+
+        # Preview frames, already scaled to display_size and in RGB. Three buffers, so the
+        # grabber always has one to fill that is neither the newest nor the one the GUI is reading.
+        self.display_size = DISPLAY_SIZE
+        self.display_enabled = True
+        self.display_buffers = None
+        self.display_scratch = None
+        self.display_published = -1
+        self.display_reading = -1
+        self.display_seq = 0
+
+        # Newest camera frame, handed from the grabber to the recognition worker
+        self.frame_ready = threading.Condition()
+        self.latest_frame = None
+        self.latest_seq = 0
+        self.processed_seq = 0
+        self.dropped_frames = 0
+
+        # Last recognition output, drawn by the grabber on every fresh frame
+        self.last_results = []
+        self.overlay = None
+
+        self.display_fps = FpsCounter()
+        self.recognition_fps = FpsCounter()
+
+        # Detection, tracking and matching; has no GUI dependencies of its own
+        self.engine = RecognitionEngine(encodings_file, matcher=matcher)
+        # With workers > 0, attendance frames go to that many worker processes instead
+        self.pool = RecognitionPool(encodings_file, workers, callback=self._on_pool_events) if workers > 0 else None
+
+        # request_profile() captures a cProfile of the recognition loop
+        self.profiler = metrics.LoopProfiler("recognition")
+        metrics.gauge(f"{name}.display_fps", lambda: round(self.display_fps.fps(), 2))
+        metrics.gauge(f"{name}.recognition_fps", lambda: round(self.recognition_fps.fps(), 2))
+        metrics.gauge(f"{name}.dropped_frames", lambda: self.dropped_frames)
+        # Frames grabbed but not yet picked up by recognition: 0 or 1, the rest are dropped
+        metrics.gauge(f"{name}.recognition_backlog", lambda: int(self.latest_seq > self.processed_seq))
         
         # Capture session variables
         self.capture_session_active = False
-        self.capture_count = 0
         self.capture_target = 20
-        self.capture_folder = ""
+        self.enrollment = None
         self.capture_callback = None
 
     def load_encodings(self):
-        if os.path.exists(self.encodings_file):
-            print("[INFO] Loading encodings...")
-            data = pickle.loads(open(self.encodings_file, "rb").read())
-            self.known_face_encodings = data["encodings"]
-            self.known_face_names = data["names"]
-        else:
-            print("[WARN] No encodings file found.")
-            self.known_face_encodings = []
-            self.known_face_names = []
+        self.engine.load_encodings()
+        if self.pool:
+            self.pool.reload_gallery()
 
     def start(self):
         if self.is_running:
             return
-        self.video_capture = cv2.VideoCapture(0)
+        try:
+            self.video_capture = open_capture(self.source)
+        except IOError as e:
+            print(f"[WARN] {e}")
+            return
         self.is_running = True
-        threading.Thread(target=self._video_loop, daemon=True).start()
+        threading.Thread(target=self._grab_loop, daemon=True).start()
+        if not self.scheduled:
+            threading.Thread(target=self._recognition_loop, daemon=True).start()
 
     def stop(self):
         self.is_running = False
+        with self.frame_ready:
+            self.frame_ready.notify_all()
         if self.video_capture:
             self.video_capture.release()
+        if self.pool:
+            self.pool.close()
 
     def set_mode(self, mode):
         self.mode = mode
+        # Boxes from the previous mode no longer describe what is on screen
+        with self.lock:
+            self.last_results = []
+            self.overlay = None
+        self.engine.reset()
+        if self.pool:
+            self.pool.reset()
+
+    def set_display_enabled(self, enabled):
+        # No preview is prepared while nobody can see it
+        self.display_enabled = enabled
 
     def start_capture_session(self, folder_path, callback):
-        self.capture_folder = folder_path
-        self.capture_count = 0
+        """
+        Enrolls the person in front of the camera into folder_path (dataset/<ID>_<Name>).
+        callback(session) gets the EnrollmentSession with the kept photos and their encodings.
+        """
+        if self.enrollment:
+            self.enrollment.cancel()
+        self.enrollment = EnrollmentSession(folder_path, os.path.basename(os.path.normpath(folder_path)),
+                                            self.capture_target, on_complete=self._on_enrollment_complete)
         self.capture_callback = callback
         self.capture_session_active = True
         self.mode = "capture"
 
-    def _video_loop(self):
+    def _grab_loop(self):
+        # Runs at camera rate: publishes the newest frame and draws the last known results on it
+        live = is_live(self.source)
+        # Files are played back at their own frame rate, like a camera would deliver them
+        interval = 0.0 if live else 1.0 / (self.video_capture.get(cv2.CAP_PROP_FPS) or 25.0)
+        next_frame_at = time.monotonic()
         while self.is_running:
             ret, frame = self.video_capture.read()
             if not ret:
+                if not live:
+                    print(f"[INFO] {self.name}: end of {self.source}.")
+                    break
                 continue
+            if interval:
+                next_frame_at += interval
+                time.sleep(max(0.0, next_frame_at - time.monotonic()))
 
-            # Flip frame for mirror effect
-            frame = cv2.flip(frame, 1)
+            if self.mirror:
+                # Flip frame for mirror effect
+                frame = cv2.flip(frame, 1)
 
-            if self.mode == "attendance":
-                self._process_attendance(frame)
-            elif self.mode == "capture":
-                self._process_capture(frame)
+            with self.frame_ready:
+                self.latest_frame = frame
+                self.latest_seq += 1
+                # Shared with the other cameras when scheduled; wake whoever waits
+                self.frame_ready.notify_all()
 
-            # Convert to RGB for tkinter
-            cv2image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA)
-            img = Image.fromarray(cv2image)
-            
-            with self.lock:
-                self.current_frame = img
+            if self.display_enabled:
+                with metrics.timer("camera.display_prepare").time():
+                    self._prepare_display(frame)
+            self.display_fps.tick()
 
-            time.sleep(0.03) # ~30 FPS
+    def _prepare_display(self, frame):
+        # Scales, annotates and converts the frame for the preview, reusing the same buffers every time
+        width, height = self.display_size
+        if self.display_buffers is None:
+            self.display_buffers = [np.empty((height, width, 3), np.uint8) for _ in range(3)]
+            self.display_scratch = np.empty((height, width, 3), np.uint8)
 
-    def _process_attendance(self, frame):
-        # Resize for faster processing
-        small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-        rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB) # face_recognition uses RGB
+        with self.lock:
+            results = self.last_results
+            overlay = self.overlay
+            busy = (self.display_published, self.display_reading)
+        index = next(i for i in range(3) if i not in busy)
 
-        face_locations = face_recognition.face_locations(rgb_small_frame)
-        face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
+        scratch = self.display_scratch
+        if frame.shape[1] == width and frame.shape[0] == height:
+            np.copyto(scratch, frame)
+        else:
+            cv2.resize(frame, (width, height), dst=scratch, interpolation=cv2.INTER_LINEAR)
+        # Results are in camera coordinates
+        sx = width / frame.shape[1]
+        sy = height / frame.shape[0]
+        self._draw_results(scratch, [
+            ((int(top * sy), int(right * sx), int(bottom * sy), int(left * sx)), name)
+            for (top, right, bottom, left), name in results
+        ])
+        if overlay:
+            text, color = overlay
+            cv2.putText(scratch, text, (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
+        cv2.cvtColor(scratch, cv2.COLOR_BGR2RGB, dst=self.display_buffers[index])
+
+        with self.lock:
+            self.display_published = index
+            self.display_seq += 1
+
+    def _recognition_loop(self):
+        # Picks up the newest frame whenever it is free; frames that arrived meanwhile are skipped
+        while self.is_running:
+            with self.frame_ready:
+                while self.is_running and self.latest_seq == self.processed_seq:
+                    self.frame_ready.wait()
+                if not self.is_running:
+                    return
+                frame = self.take_frame()
+            self.recognize(frame)
+
+    def take_frame(self):
+        """
+        Returns the newest frame not yet recognized, or None. Call with frame_ready held.
+        Frames that arrived in between are counted as dropped.
+        """
+        if self.latest_seq == self.processed_seq:
+            return None
+        if self.processed_seq:
+            self.dropped_frames += self.latest_seq - self.processed_seq - 1
+        self.processed_seq = self.latest_seq
+        return self.latest_frame
 
-        face_names = []
-        for face_encoding in face_encodings:
-            matches = face_recognition.compare_faces(self.known_face_encodings, face_encoding)
-            name = "Unknown"
+    def recognize(self, frame):
+        # One step of the recognition loop, for the current mode
+        self.profiler.tick()
+        if self.mode == "attendance" and self.pool:
+            # Returns at once; results come back through _on_pool_events
+            self.pool.submit(frame)
+            return
+        if self.mode == "attendance":
+            with metrics.timer("camera.recognition").time():
+                results = self._process_attendance(frame)
+            with self.lock:
+                self.last_results = results
+                self.overlay = None
+        elif self.mode == "capture":
+            self._process_capture(frame)
+        self.recognition_fps.tick()
 
-            if True in matches:
-                first_match_index = matches.index(True)
-                name = self.known_face_names[first_match_index]
+    def _process_attendance(self, frame):
+        # Returns [((top, right, bottom, left), name)] in full-frame coordinates
+        events = self.engine.process(frame)
+        if events is None:
+            # Nothing changed since the last frame; the previous boxes still hold
+            return self.last_results
+        return self._handle_events(events)
 
-            face_names.append(name)
+    def _handle_events(self, events):
+        results = []
+        for event in events:
+            name = event.identity
+            results.append((event.box, name))
             
             if self.detection_callback:
-                self.detection_callback(name)
+                with metrics.timer("camera.detection_callback").time():
+                    self.detection_callback(name)
+        return results
 
-        # Draw boxes
-        for (top, right, bottom, left), name in zip(face_locations, face_names):
-            top *= 4
-            right *= 4
-            bottom *= 4
-            left *= 4
+    def _on_pool_events(self, events):
+        # Called from the pool's result thread
+        if self.mode != "attendance":
+            return
+        results = self._handle_events(events)
+        with self.lock:
+            self.last_results = results
+            self.overlay = None
+        self.recognition_fps.tick()
 
+    def _draw_results(self, frame, results):
+        # Draw boxes
+        for (top, right, bottom, left), name in results:
             color = (0, 255, 0) if name != "Unknown" else (0, 0, 255)
             cv2.rectangle(frame, (left, top), (right, bottom), color, 2)
             cv2.rectangle(frame, (left, bottom - 35), (right, bottom), color, cv2.FILLED)
@@ -120,24 +303,48 @@ class CameraService:
 
     def _process_capture(self, frame):
         if self.capture_session_active:
-            if self.capture_count < self.capture_target:
-                # Save frame
-                filename = f"{self.capture_folder}/img_{self.capture_count}.jpg"
-                cv2.imwrite(filename, frame)
-                self.capture_count += 1
-                
-                # Visual feedback
-                cv2.putText(frame, f"Capturing {self.capture_count}/{self.capture_target}", (50, 50), 
-                            cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-                
-                time.sleep(0.2) # Delay between captures
-            else:
-                self.capture_session_active = False
-                if self.capture_callback:
-                    self.capture_callback()
+            # Checked and encoded on the session's own thread; this returns at once
+            self.enrollment.offer(frame)
+            
+            # Visual feedback
+            with self.lock:
+                self.overlay = (self.enrollment.status, (0, 0, 255))
         else:
-            cv2.putText(frame, "Capture Mode", (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 2)
+            with self.lock:
+                self.overlay = ("Capture Mode", (255, 0, 0))
+
+    def _on_enrollment_complete(self, session):
+        if session is not self.enrollment:
+            return
+        self.capture_session_active = False
+        with self.lock:
+            self.overlay = (session.status, (0, 255, 0) if session.succeeded else (0, 0, 255))
+        if self.capture_callback:
+            self.capture_callback(session)
+
+    def request_profile(self, seconds=10, path=None):
+        # The profile is written (and its top entries printed) once the time is up
+        self.profiler.request(seconds, path)
+
+    def get_stats(self):
+        return {
+            "display_fps": self.display_fps.fps(),
+            "recognition_fps": self.recognition_fps.fps(),
+            "dropped_frames": self.dropped_frames,
+            "detection": (self.pool or self.engine).detection_policy.stats(),
+        }
+
+    def acquire_display_frame(self, seen_seq=0):
+        """
+        Returns (seq, RGB array of display_size) if a preview newer than seen_seq is ready,
+        else (seen_seq, None). The array stays untouched until release_display_frame().
+        """
+        with self.lock:
+            if self.display_published < 0 or self.display_seq == seen_seq:
+                return seen_seq, None
+            self.display_reading = self.display_published
+            return self.display_seq, self.display_buffers[self.display_reading]
 
-    def get_frame(self):
+    def release_display_frame(self):
         with self.lock:
-            return self.current_frame
+            self.display_reading = -1
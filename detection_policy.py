@@ -0,0 +1,181 @@
+import time
+from collections import namedtuple
+import cv2
+
+# regions are (top, right, bottom, left) in full-frame pixels
+DetectionPlan = namedtuple("DetectionPlan", ["scale", "regions", "full"])
+
+class DetectionPolicy:
+    """
+    Decides where and at what scale face detection runs on a frame.
+    - The scale follows the size of the faces seen so far, so small faces at the
+      back of a room are still found on high-resolution cameras.
+    - Between periodic full scans only regions that changed (differencing a small
+      thumbnail against the one from the last scan of that area, so slow movement
+      adds up) and the areas around existing tracks are scanned.
+    - Frames where nothing moved are not scanned at all.
+    """
+    def __init__(self, target_face_px=60, search_height=360, min_scale=0.2, max_scale=1.0,
+                 full_interval=30, motion_threshold=20, motion_min_area=0.002,
+                 thumb_width=160, track_margin=0.5, max_roi_fraction=0.6):
+        self.target_face_px = target_face_px
+        self.search_height = search_height
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.full_interval = full_interval
+        self.motion_threshold = motion_threshold
+        self.motion_min_area = motion_min_area
+        self.thumb_width = thumb_width
+        self.track_margin = track_margin
+        self.max_roi_fraction = max_roi_fraction
+
+        self.reference_thumb = None # Thumbnail as of the last scan of each area
+        self.thumb = None
+        self.thumb_factor = 1.0
+        self.face_height = None
+        self.last_scale = None
+        self.frames_since_full = 0
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.counters = {
+            "frames": 0,
+            "full_scans": 0,
+            "roi_scans": 0,
+            "skipped": 0,
+            "regions_scanned": 0,
+            "pixels_scanned": 0,
+            "motion_seconds": 0.0,
+            "detect_seconds": 0.0,
+        }
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats["scale"] = self.last_scale
+        scanned = stats["full_scans"] + stats["roi_scans"]
+        stats["avg_detect_ms"] = 1000.0 * stats["detect_seconds"] / scanned if scanned else 0.0
+        return stats
+
+    def current_scale(self, frame_height):
+        if self.face_height:
+            scale = self.target_face_px / self.face_height
+        else:
+            scale = self.search_height / frame_height
+        return min(self.max_scale, max(self.min_scale, scale))
+
+    def observe(self, boxes):
+        # Tracks the smallest face height (moving average) to pick the next scale
+        if not boxes:
+            return
+        smallest = min(bottom - top for top, right, bottom, left in boxes)
+        if self.face_height is None:
+            self.face_height = float(smallest)
+        else:
+            self.face_height = 0.8 * self.face_height + 0.2 * smallest
+
+    def record_detection(self, seconds):
+        self.counters["detect_seconds"] += seconds
+
+    def plan(self, frame, track_boxes, force_full=False):
+        """
+        Returns a DetectionPlan, or None when the frame should not be scanned.
+        """
+        self.counters["frames"] += 1
+        height, width = frame.shape[:2]
+        scale = self.last_scale = self.current_scale(height)
+
+        started = time.perf_counter()
+        motion_regions = self._motion_regions(frame)
+        self.counters["motion_seconds"] += time.perf_counter() - started
+
+        self.frames_since_full += 1
+        if force_full or motion_regions is None or self.frames_since_full >= self.full_interval:
+            return self._full(width, height, scale)
+
+        if not motion_regions:
+            # The reference is kept, so changes too small to count yet add up over the next frames
+            self.counters["skipped"] += 1
+            return None
+
+        regions = motion_regions + [self._expand(box, width, height) for box in track_boxes]
+        regions = _merge(regions)
+        area = sum((r - l) * (b - t) for t, r, b, l in regions)
+        if area > self.max_roi_fraction * width * height:
+            return self._full(width, height, scale)
+
+        self._scanned(regions)
+        self.counters["roi_scans"] += 1
+        self.counters["regions_scanned"] += len(regions)
+        self.counters["pixels_scanned"] += int(area * scale * scale)
+        return DetectionPlan(scale, regions, False)
+
+    def _full(self, width, height, scale):
+        self.reference_thumb = self.thumb
+        self.frames_since_full = 0
+        self.counters["full_scans"] += 1
+        self.counters["regions_scanned"] += 1
+        self.counters["pixels_scanned"] += int(width * height * scale * scale)
+        return DetectionPlan(scale, [(0, width, height, 0)], True)
+
+    def _expand(self, box, width, height):
+        top, right, bottom, left = box
+        dx = int((right - left) * self.track_margin)
+        dy = int((bottom - top) * self.track_margin)
+        return (max(0, top - dy), min(width, right + dx), min(height, bottom + dy), max(0, left - dx))
+
+    def _scanned(self, regions):
+        # Only the scanned areas move on; elsewhere the difference keeps adding up
+        factor = self.thumb_factor
+        for top, right, bottom, left in regions:
+            rows = slice(int(top / factor), int(bottom / factor) + 1)
+            cols = slice(int(left / factor), int(right / factor) + 1)
+            self.reference_thumb[rows, cols] = self.thumb[rows, cols]
+
+    def _motion_regions(self, frame):
+        # Changed areas since each area was last scanned, or None when there is nothing to compare with
+        height, width = frame.shape[:2]
+        factor = self.thumb_factor = width / float(self.thumb_width)
+        thumb = cv2.resize(frame, (self.thumb_width, max(1, int(height / factor))), interpolation=cv2.INTER_AREA)
+        thumb = self.thumb = cv2.GaussianBlur(cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+
+        previous = self.reference_thumb
+        if previous is None or previous.shape != thumb.shape:
+            return None
+
+        _, mask = cv2.threshold(cv2.absdiff(previous, thumb), self.motion_threshold, 255, cv2.THRESH_BINARY)
+        mask = cv2.dilate(mask, None, iterations=2)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        min_area = self.motion_min_area * thumb.shape[0] * thumb.shape[1]
+        regions = []
+        for contour in contours:
+            if cv2.contourArea(contour) < min_area:
+                continue
+            x, y, w, h = cv2.boundingRect(contour)
+            # A moving person's face can sit just above the moving area, so pad generously
+            pad = max(w, h) // 2
+            regions.append((
+                max(0, int((y - pad) * factor)),
+                min(width, int((x + w + pad) * factor)),
+                min(height, int((y + h + pad) * factor)),
+                max(0, int((x - pad) * factor)),
+            ))
+        return regions
+
+def _merge(regions):
+    # Merges overlapping boxes until none overlap, so no pixel is scanned twice
+    regions = list(regions)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                a, b = regions[i], regions[j]
+                if a[3] < b[1] and b[3] < a[1] and a[0] < b[2] and b[0] < a[2]:
+                    regions[i] = (min(a[0], b[0]), max(a[1], b[1]), max(a[2], b[2]), min(a[3], b[3]))
+                    del regions[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return regions
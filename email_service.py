@@ -1,8 +1,14 @@
-import smtplib
+import hashlib
 import threading
+from string import Template
+from datetime import datetime, timedelta
+from concurrent.futures import wait
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from database_manager import DatabaseManager
+import metrics
+from smtp_pool import SmtpDeliveryPool
+from utils import join_names
 
 # CONFIGURATION
 # NOTE: To use Gmail, you must enable 2-Factor Authentication and generate an App Password.
@@ -10,60 +16,238 @@ from database_manager import DatabaseManager
 SENDER_EMAIL = "your_email@gmail.com" 
 APP_PASSWORD = "your_app_password"
 
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 587
+
+# Delivery limits; Gmail throttles accounts that open many sessions or send in bursts
+SMTP_CONNECTIONS = 3
+SMTP_RATE_PER_SECOND = 5
+
+# Outbox delivery: messages claimed per batch, idle poll interval, and retries after the pool gives up
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_POLL_SECONDS = 5.0
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_SECONDS = 60
+
+# Message templates, parsed once at import instead of formatted inline per recipient
+PRESENT_SUBJECT = "Attendance Confirmation"
+PRESENT_TEMPLATE = Template(
+    "Hi $name,\n\nYou have been marked PRESENT for today's class.\n\nRegards,\nSmartGuard System"
+)
+ABSENT_SUBJECT = "Absent Alert"
+ABSENT_TEMPLATE = Template(
+    "Dear Parent,\n\nYour ward $name was marked ABSENT for today's class.\n\n"
+    "Please contact the administration if this is a mistake.\n\nRegards,\nSmartGuard System"
+)
+# One email for a parent with several absent wards
+ABSENT_DIGEST_TEMPLATE = Template(
+    "Dear Parent,\n\nYour wards $names were marked ABSENT for today's class.\n\n"
+    "Please contact the administration if this is a mistake.\n\nRegards,\nSmartGuard System"
+)
+
+def _message_id(key):
+    # Stable per outbox entry, so a message delivered twice (at-least-once) can be recognized as a duplicate
+    return f"<{hashlib.sha1(key.encode('utf-8')).hexdigest()}@smartguard>"
+
+class OutboxDispatcher:
+    """
+    Background thread that drains the outbox table in batches.
+    A message is marked sent only after the server accepted it, so nothing is lost if
+    the app stops mid-batch; such messages are sent again on the next start.
+    """
+    def __init__(self, email_service, batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_SECONDS,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS, retry_seconds=OUTBOX_RETRY_SECONDS):
+        self.email_service = email_service
+        self.db = email_service.db
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def wake(self):
+        # Called after enqueueing so new messages go out without waiting for the next poll
+        self.wake_event.set()
+
+    def _run(self):
+        resume = True
+        errors = 0
+        while not self.stop_event.is_set():
+            try:
+                if resume:
+                    # Also after a database error, which may have left a claimed batch in 'sending'
+                    requeued = self.db.requeue_interrupted_outbox()
+                    if requeued:
+                        print(f"[INFO] Resuming delivery of {requeued} interrupted email(s).")
+                    resume = False
+
+                if self.email_service.smtp_pool.auth_error is not None:
+                    # Messages stay pending until the SMTP credentials are fixed
+                    self.wake_event.wait(self.poll_interval)
+                    self.wake_event.clear()
+                    continue
+                batch = self.db.claim_outbox(self.batch_size)
+                if not batch:
+                    self.wake_event.wait(self.poll_interval)
+                    self.wake_event.clear()
+                    continue
+                self._deliver(batch)
+                errors = 0
+            except RuntimeError:
+                break # Pool closed during shutdown; the claimed rows are requeued on the next start
+            except Exception as e:
+                # e.g. "database is locked"; the thread must outlive it or nothing is sent until a restart
+                errors += 1
+                resume = True
+                metrics.counter("email.outbox_errors").inc()
+                delay = min(self.retry_seconds, self.poll_interval * 2 ** (errors - 1))
+                print(f"[WARN] Outbox delivery failed ({e}); retrying in {delay:g}s.")
+                self.stop_event.wait(delay)
+
+    @metrics.timed("email.outbox_batch")
+    def _deliver(self, batch):
+        futures = []
+        for row in batch:
+            message_id, key, recipient, subject, body, attempts = row
+            msg = self.email_service.build_message(recipient, subject, body, _message_id(key))
+            futures.append((row, self.email_service.smtp_pool.submit(msg)))
+        wait([future for _, future in futures])
+
+        sent = []
+        for (message_id, key, recipient, subject, body, attempts), future in futures:
+            error = future.exception()
+            if error is None:
+                sent.append(message_id)
+            elif attempts + 1 >= self.max_attempts:
+                print(f"[WARN] Giving up on email to {recipient}: {error}")
+                self.db.fail_outbox(message_id, error)
+            else:
+                retry_at = datetime.now() + timedelta(seconds=self.retry_seconds * 2 ** attempts)
+                self.db.fail_outbox(message_id, error, retry_at)
+        if sent:
+            self.db.complete_outbox(sent)
+        metrics.counter("email.sent").inc(len(sent))
+        metrics.counter("email.failed").inc(len(batch) - len(sent))
+        print(f"[INFO] Outbox batch done: {len(sent)} sent, {len(batch) - len(sent)} failed.")
+
 class EmailService:
-    def __init__(self):
-        self.db = DatabaseManager()
+    def __init__(self, db=None, smtp_pool=None, start_dispatcher=True):
+        # Shares the app's DatabaseManager (and its per-thread connections) when given one
+        self.db = db or DatabaseManager()
+        # Pass a pool pointed at a local test server (e.g. aiosmtpd, use_tls=False) to try this out safely
+        self.smtp_pool = smtp_pool or SmtpDeliveryPool(
+            SMTP_HOST, SMTP_PORT, SENDER_EMAIL, APP_PASSWORD,
+            connections=SMTP_CONNECTIONS, rate_per_second=SMTP_RATE_PER_SECOND,
+        )
+        # Attendance emails go through the outbox table; the dispatcher picks up anything left from the last run
+        self.dispatcher = OutboxDispatcher(self)
+        metrics.gauge("email.outbox_pending", lambda: self.db.outbox_counts()["pending"])
+        if start_dispatcher:
+            self.dispatcher.start()
+
+    def build_message(self, recipient, subject, body, message_id=None):
+        msg = MIMEMultipart()
+        msg['From'] = SENDER_EMAIL
+        msg['To'] = recipient
+        msg['Subject'] = subject
+        if message_id:
+            msg['Message-ID'] = message_id
+        msg.attach(MIMEText(body, 'plain'))
+        return msg
 
     def send_email(self, recipient, subject, body):
-        try:
-            msg = MIMEMultipart()
-            msg['From'] = SENDER_EMAIL
-            msg['To'] = recipient
-            msg['Subject'] = subject
-            msg.attach(MIMEText(body, 'plain'))
-
-            server = smtplib.SMTP('smtp.gmail.com', 587)
-            server.starttls()
-            server.login(SENDER_EMAIL, APP_PASSWORD)
-            server.send_message(msg)
-            server.quit()
+        """
+        Queues one email on the shared SMTP connections, bypassing the outbox. Returns a Future.
+        """
+        future = self.smtp_pool.submit(self.build_message(recipient, subject, body))
+        future.add_done_callback(lambda f: self._report(recipient, f))
+        return future
+
+    def _report(self, recipient, future):
+        error = future.exception()
+        if error is None:
             print(f"Email sent to {recipient}")
-        except Exception as e:
-            print(f"Failed to send email to {recipient}: {e}")
+        else:
+            print(f"Failed to send email to {recipient}: {error}")
 
-    def process_attendance_emails(self, present_ids):
+    def close(self):
+        self.dispatcher.stop(timeout=1.0)
+        self.smtp_pool.close(wait=False)
+
+    def outbox_counts(self):
+        # {"pending": n, "sending": n, "sent": n, "failed": n}
+        return self.db.outbox_counts()
+
+    def plan_attendance_emails(self, present_ids, date_str=None, absent_students=None):
         """
-        Runs the email sending process in a background thread.
+        Builds the day's attendance emails as outbox messages: a confirmation to each
+        student in present_ids and an alert to the parent of each student with no
+        attendance that day (absent_students, as users rows; read from the database
+        when not given). A parent with several absent wards gets one email listing all of them.
+        The idempotency key (date, kind, students, recipient) makes a repeated save a no-op,
+        and a ward whose parent was already alerted that day is left out of later alerts.
         """
-        threading.Thread(target=self._process_emails_thread, args=(present_ids,), daemon=True).start()
-
-    def _process_emails_thread(self, present_ids):
-        students = self.db.get_students()
-        
-        present_students = []
-        absent_students = []
-
-        for student in students:
-            s_id, s_name, _, s_email, p_email = student
-            if s_id in present_ids:
-                present_students.append((s_name, s_email))
+        date_str = date_str or datetime.now().strftime("%Y-%m-%d")
+        present_ids = {str(uid) for uid in present_ids}
+        if absent_students is None:
+            absent_students = self.db.get_absent_students(date_str)
+
+        messages = []
+        for s_id in sorted(present_ids):
+            student = self.db.users.get(s_id)
+            if student and student.role == "Student" and student.email_student:
+                messages.append({
+                    "key": f"{date_str}:present:{s_id}:{student.email_student}",
+                    "recipient": student.email_student,
+                    "subject": PRESENT_SUBJECT,
+                    "body": PRESENT_TEMPLATE.substitute(name=student.name),
+                })
+
+        # (ward, parent email) pairs alerted by an earlier save today, from the keys below
+        alerted = set()
+        for key in self.db.outbox_keys(f"{date_str}:absent:"):
+            _, _, ids, email = key.split(":", 3)
+            alerted.update((s_id, email) for s_id in ids.split("+"))
+
+        absent_by_parent = {} # {parent email: [(id, name)]}, in student order
+        for s_id, s_name, _, _, p_email in absent_students:
+            if p_email and (s_id, p_email) not in alerted:
+                absent_by_parent.setdefault(p_email, []).append((s_id, s_name))
+
+        for email, wards in absent_by_parent.items():
+            ids = "+".join(s_id for s_id, _ in wards)
+            if len(wards) == 1:
+                body = ABSENT_TEMPLATE.substitute(name=wards[0][1])
             else:
-                absent_students.append((s_name, p_email))
-
-        # Send Present Emails
-        for name, email in present_students:
-            if email:
-                self.send_email(
-                    email, 
-                    "Attendance Confirmation", 
-                    f"Hi {name},\n\nYou have been marked PRESENT for today's class.\n\nRegards,\nSmartGuard System"
-                )
-
-        # Send Absent Emails
-        for name, email in absent_students:
-            if email:
-                self.send_email(
-                    email, 
-                    "Absent Alert", 
-                    f"Dear Parent,\n\nYour ward {name} was marked ABSENT for today's class.\n\nPlease contact the administration if this is a mistake.\n\nRegards,\nSmartGuard System"
-                )
+                body = ABSENT_DIGEST_TEMPLATE.substitute(names=join_names([name for _, name in wards]))
+            messages.append({
+                "key": f"{date_str}:absent:{ids}:{email}",
+                "recipient": email,
+                "subject": ABSENT_SUBJECT,
+                "body": body,
+            })
+
+        return messages
+
+    def process_attendance_emails(self, present_ids):
+        """
+        Queues the attendance emails in the outbox and wakes the dispatcher.
+        Absentees are those not marked yet, so call this after the attendance is saved.
+        App.save_attendance queues them together with the attendance rows instead.
+        """
+        self.db.enqueue_outbox(self.plan_attendance_emails(present_ids))
+        self.dispatcher.wake()
@@ -1,58 +1,205 @@
 import os
-import pickle
+import json
+import argparse
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import face_recognition
 
+import metrics
+from face_matcher import build_prototype_index
+from gallery_store import DEFAULT_GALLERY_FILE, LEGACY_PICKLE_FILE, append_to_gallery, load_gallery, write_gallery, migrate_legacy_pickle
+
 
 DATASET_PATH = "dataset"
-ENCODINGS_FILE = "encodings.pickle"
+ENCODINGS_FILE = DEFAULT_GALLERY_FILE
+MANIFEST_FILE = "encodings.manifest.json"
+
+# Images handed to a worker process at a time
+DEFAULT_CHUNKSIZE = 4
+
+def encode_image(imagePath):
+    # Load the input image and convert it from BGR (OpenCV ordering)
+    # to RGB (dlib ordering)
+    image = face_recognition.load_image_file(imagePath)
+    # face_recognition loads as RGB by default if using load_image_file
+
+    # Detect the (x, y)-coordinates of the bounding boxes
+    # corresponding to each face in the input image
+    boxes = face_recognition.face_locations(image, model="hog")
+
+    # Compute the facial embedding for the face
+    return face_recognition.face_encodings(image, boxes)
+
+def print_progress(done, total):
+    print(f"[INFO] Processing image {done}/{total}")
 
 class Encoder:
-    def encode_faces(self):
+    def __init__(self):
+        # Enrollment and deletion can both trigger a retrain; only one may write the files at a time
+        self.lock = threading.Lock()
+
+    @metrics.timed("encoder.encode_faces")
+    def encode_faces(self, incremental=False, workers=None, chunksize=DEFAULT_CHUNKSIZE, progress_callback=None):
+        """
+        Encodes every image under DATASET_PATH.
+        With incremental=True only new or changed images are encoded; encodings of
+        unchanged images are reused and images that no longer exist are dropped.
+        Images are spread over `workers` processes (default: one per core) in chunks of
+        `chunksize`, and progress_callback(done, total) is called as results come back.
+        """
+        with self.lock:
+            self._encode_faces(incremental, workers, chunksize, progress_callback or print_progress)
+
+    def add_encodings(self, encodings, names, imagePaths):
+        """
+        Adds encodings computed elsewhere (e.g. during enrollment) to the gallery, without
+        encoding or re-indexing anyone else. The images go into the manifest, so later
+        incremental runs reuse these encodings instead of encoding the images again.
+        """
+        with self.lock:
+            migrate_legacy_pickle(LEGACY_PICKLE_FILE, ENCODINGS_FILE)
+            append_to_gallery(ENCODINGS_FILE, encodings, names, imagePaths)
+
+            manifest = self._load_manifest()
+            for imagePath in set(imagePaths):
+                manifest[imagePath] = self._file_signature(imagePath, None)
+            with open(MANIFEST_FILE, "w") as f:
+                json.dump(manifest, f, indent=1)
+            print(f"[INFO] Added {len(encodings)} encoding(s) to the gallery.")
+
+    def _encode_faces(self, incremental, workers, chunksize, progress_callback):
         print("[INFO] Quantifying faces...")
+        imagePaths = self._list_images()
+
+        previous = self._load_previous() if incremental else None
+        manifest = self._load_manifest() if previous is not None else {}
+        previous = previous or {}
+
+        signatures = {}
+        toEncode = []
+        for imagePath in imagePaths:
+            signature = self._file_signature(imagePath, manifest.get(imagePath))
+            signatures[imagePath] = signature
+            # Unchanged since the last run (images without a face have no encodings)
+            if manifest.get(imagePath, {}).get("sha1") != signature["sha1"]:
+                toEncode.append(imagePath)
+
+        with metrics.timer("encoder.encode_images").time():
+            fresh = dict(zip(toEncode, self._encode_images(toEncode, workers, chunksize, progress_callback)))
+        metrics.counter("encoder.images_encoded").inc(len(toEncode))
+
+        knownEncodings = []
+        knownNames = []
+        knownPaths = []
+        for imagePath in imagePaths:
+            name = self._identity_for(imagePath)
+            encodings = fresh[imagePath] if imagePath in fresh else previous.get(imagePath, [])
+
+            # Loop over the encodings
+            for encoding in encodings:
+                knownEncodings.append(encoding)
+                knownNames.append(name)
+                knownPaths.append(imagePath)
+
+        dropped = len(set(manifest) - set(signatures))
+        print(f"[INFO] Encoded {len(toEncode)} image(s), reused {len(imagePaths) - len(toEncode)}, dropped {dropped}.")
+
+        print("[INFO] Building prototype index...")
+        index = build_prototype_index(knownEncodings, knownNames)
+
+        print("[INFO] Serializing encodings...")
+        with metrics.timer("encoder.write_gallery").time():
+            write_gallery(ENCODINGS_FILE, knownEncodings, knownNames, knownPaths, index)
+
+        # Written after the encodings so a crash in between only costs a re-encode
+        with open(MANIFEST_FILE, "w") as f:
+            json.dump(signatures, f, indent=1)
+        print("[INFO] Encodings saved.")
+
+    def _list_images(self):
         imagePaths = []
-        
+
         # Traverse the dataset directory
         for root, dirs, files in os.walk(DATASET_PATH):
             for file in files:
                 if file.lower().endswith(('.png', '.jpg', '.jpeg')):
                     imagePaths.append(os.path.join(root, file))
 
-        knownEncodings = []
-        knownNames = []
+        # Sorted so the encodings file is the same no matter how the filesystem orders entries
+        return sorted(imagePaths)
 
-        for (i, imagePath) in enumerate(imagePaths):
-            print(f"[INFO] Processing image {i + 1}/{len(imagePaths)}")
-            # Extract the person name from the image path
-            # Structure: dataset/ID_Name/image.jpg
-            path_parts = imagePath.split(os.path.sep)
-            # Assuming the folder name is the ID_Name or just Name. 
-            # The prompt says "dataset/[ID]_[Name]"
-            folder_name = path_parts[-2]
-            name = folder_name # We will use the folder name as the identifier
+    def _identity_for(self, imagePath):
+        # Extract the person name from the image path
+        # Structure: dataset/ID_Name/image.jpg
+        path_parts = imagePath.split(os.path.sep)
+        # Assuming the folder name is the ID_Name or just Name.
+        # The prompt says "dataset/[ID]_[Name]"
+        folder_name = path_parts[-2]
+        return folder_name # We will use the folder name as the identifier
 
-            # Load the input image and convert it from BGR (OpenCV ordering)
-            # to RGB (dlib ordering)
-            image = face_recognition.load_image_file(imagePath)
-            # face_recognition loads as RGB by default if using load_image_file
+    def _encode_images(self, imagePaths, workers, chunksize, progress_callback):
+        # Yields the encodings of each image, in the order of imagePaths
+        total = len(imagePaths)
+        workers = min(workers or os.cpu_count() or 1, max(total, 1))
 
-            # Detect the (x, y)-coordinates of the bounding boxes
-            # corresponding to each face in the input image
-            boxes = face_recognition.face_locations(image, model="hog")
+        if workers <= 1:
+            results = map(encode_image, imagePaths)
+            for done, encodings in enumerate(results, 1):
+                progress_callback(done, total)
+                yield encodings
+            return
 
-            # Compute the facial embedding for the face
-            encodings = face_recognition.face_encodings(image, boxes)
+        # executor.map keeps input order while results stream back chunk by chunk
+        # spawn, not fork: the app calls this from a thread of a multi-threaded Tk process
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results = executor.map(encode_image, imagePaths, chunksize=chunksize)
+            for done, encodings in enumerate(results, 1):
+                progress_callback(done, total)
+                yield encodings
 
-            # Loop over the encodings
-            for encoding in encodings:
-                knownEncodings.append(encoding)
-                knownNames.append(name)
+    def _file_signature(self, imagePath, entry):
+        stat = os.stat(imagePath)
 
-        print("[INFO] Serializing encodings...")
-        data = {"encodings": knownEncodings, "names": knownNames}
-        with open(ENCODINGS_FILE, "wb") as f:
-            f.write(pickle.dumps(data))
-        print("[INFO] Encodings saved.")
+        # Same size and mtime as last time: trust the stored hash instead of re-reading the file
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return entry
+
+        with open(imagePath, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        return {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": digest}
+
+    def _load_manifest(self):
+        if not os.path.exists(MANIFEST_FILE):
+            return {}
+        with open(MANIFEST_FILE) as f:
+            return json.load(f)
+
+    def _load_previous(self):
+        # Groups the stored encodings by source image: {path: [encodings]}
+        # Returns None when there is nothing usable to build on
+        migrate_legacy_pickle(LEGACY_PICKLE_FILE, ENCODINGS_FILE)
+        if not os.path.exists(ENCODINGS_FILE):
+            return None
+        gallery = load_gallery(ENCODINGS_FILE)
+        sources = gallery.sources
+        if len(gallery) and not any(sources):
+            print("[WARN] Encodings file has no source paths, re-encoding everything.")
+            return None
+
+        previous = {}
+        for encoding, path in zip(gallery.embeddings, sources):
+            previous.setdefault(path, []).append(np.array(encoding))
+        return previous
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encode the faces in the dataset folder.")
+    parser.add_argument("--incremental", action="store_true", help="only encode new or changed images")
+    parser.add_argument("--workers", type=int, default=None, help="number of encoding processes (default: one per core)")
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE, help="images handed to a worker at a time")
+    args = parser.parse_args()
+
     encoder = Encoder()
-    encoder.encode_faces()
+    encoder.encode_faces(incremental=args.incremental, workers=args.workers, chunksize=args.chunksize)
@@ -0,0 +1,182 @@
+import os
+import math
+import time
+import threading
+import numpy as np
+import cv2
+import face_recognition
+
+import metrics
+
+# Quality gates for an enrollment frame
+MIN_FACE_PX = 80            # Face height in the full frame
+BLUR_THRESHOLD = 60.0       # Variance of the Laplacian over the face; lower is blurrier
+MAX_YAW = 0.3               # Nose offset from the middle of the eyes, relative to the eye distance
+MAX_ROLL_DEGREES = 20.0     # Tilt of the line between the eyes
+DUPLICATE_DISTANCE = 0.12   # An embedding this close to an accepted one adds nothing new
+DETECT_SCALE = 0.5          # Detection runs on a downscaled frame; embedding on the full one
+
+DEFAULT_TARGET = 20
+MIN_ACCEPTED = 5            # Fewest frames an enrollment may finish with when it times out
+DEFAULT_TIMEOUT = 30.0
+
+def _blur_score(gray_face):
+    # Normalized to a fixed height so the score does not depend on how close the person stands
+    height = gray_face.shape[0]
+    if height != 128:
+        gray_face = cv2.resize(gray_face, (max(1, int(gray_face.shape[1] * 128 / height)), 128))
+    return cv2.Laplacian(gray_face, cv2.CV_64F).var()
+
+def _pose(landmarks):
+    # Returns (yaw ratio, roll in degrees) from the eye and nose landmarks
+    left_eye = np.mean(landmarks["left_eye"], axis=0)
+    right_eye = np.mean(landmarks["right_eye"], axis=0)
+    nose = np.mean(landmarks["nose_tip"], axis=0)
+    dx, dy = right_eye - left_eye
+    eye_distance = math.hypot(dx, dy) or 1.0
+    yaw = abs(nose[0] - (left_eye[0] + right_eye[0]) / 2.0) / eye_distance
+    roll = abs(math.degrees(math.atan2(dy, dx)))
+    return yaw, min(roll, 180.0 - roll)
+
+def check_frame(frame):
+    """
+    Runs the quality gates on one BGR frame.
+    Returns (encoding, None) for a usable frame, or (None, reason) saying what to fix.
+    """
+    small = cv2.resize(frame, (0, 0), fx=DETECT_SCALE, fy=DETECT_SCALE)
+    locations = face_recognition.face_locations(cv2.cvtColor(small, cv2.COLOR_BGR2RGB))
+    if not locations:
+        return None, "No face found"
+    if len(locations) > 1:
+        return None, "Only one person please"
+
+    top, right, bottom, left = (int(v / DETECT_SCALE) for v in locations[0])
+    height, width = frame.shape[:2]
+    top, left = max(0, top), max(0, left)
+    bottom, right = min(height, bottom), min(width, right)
+    if bottom - top < MIN_FACE_PX:
+        return None, "Move closer"
+
+    gray_face = cv2.cvtColor(frame[top:bottom, left:right], cv2.COLOR_BGR2GRAY)
+    if _blur_score(gray_face) < BLUR_THRESHOLD:
+        return None, "Hold still"
+
+    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    box = (top, right, bottom, left)
+    landmarks = face_recognition.face_landmarks(rgb, [box])
+    if landmarks and all(key in landmarks[0] for key in ("left_eye", "right_eye", "nose_tip")):
+        yaw, roll = _pose(landmarks[0])
+        if yaw > MAX_YAW or roll > MAX_ROLL_DEGREES:
+            return None, "Look at the camera"
+
+    encodings = face_recognition.face_encodings(rgb, [box])
+    if not encodings:
+        return None, "No face found"
+    return encodings[0], None
+
+class EnrollmentSession:
+    """
+    Collects enrollment photos of one person from the live feed, off the video thread.
+    The camera offers every frame; the session checks the newest one whenever it is free
+    and keeps it only if it shows exactly one sharp, large enough, frontal face that is
+    not a near-duplicate of a photo already kept. The face's embedding is computed as the
+    photo is kept, so the gallery can be updated right away without re-reading the images.
+    on_complete(session) is called from the session's thread when it is done.
+    """
+    def __init__(self, folder, identity, target=DEFAULT_TARGET, on_complete=None,
+                 timeout=DEFAULT_TIMEOUT, min_accepted=MIN_ACCEPTED):
+        self.folder = folder
+        self.identity = identity
+        self.target = target
+        self.on_complete = on_complete
+        self.timeout = timeout
+        self.min_accepted = min_accepted
+
+        self.paths = []
+        self.encodings = []
+        self.rejected = 0
+        self.status = "Look at the camera"
+        self.done = False
+
+        self.condition = threading.Condition()
+        self.pending = None
+        self.cancelled = False
+        self.started = None
+        self.thread = None
+
+    @property
+    def count(self):
+        return len(self.paths)
+
+    @property
+    def succeeded(self):
+        return self.done and self.count >= self.min_accepted
+
+    def offer(self, frame):
+        # Never blocks: a frame offered while the previous one is being checked replaces it
+        with self.condition:
+            if self.done or self.cancelled:
+                return
+            self.pending = frame
+            if self.thread is None:
+                self.started = time.monotonic()
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def discard(self):
+        # Deletes only the photos this session saved, and the folder if that leaves it empty
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+        try:
+            os.rmdir(self.folder)
+        except OSError:
+            pass # Not empty: it holds files this session did not create
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.cancelled and not self._timed_out():
+                    self.condition.wait(1.0)
+                if self.cancelled:
+                    return
+                frame, self.pending = self.pending, None
+            if frame is None: # Timed out
+                break
+
+            with metrics.timer("enrollment.check_frame").time():
+                self._consider(frame)
+            if self.count >= self.target or self._timed_out():
+                break
+
+        self.done = True
+        self.status = f"Captured {self.count}/{self.target}" if self.succeeded else "Enrollment failed, try again"
+        print(f"[INFO] Enrollment of {self.identity}: {self.count} photo(s) kept, {self.rejected} rejected.")
+        if self.on_complete:
+            self.on_complete(self)
+
+    def _timed_out(self):
+        return time.monotonic() - self.started > self.timeout
+
+    def _consider(self, frame):
+        encoding, reason = check_frame(frame)
+        if encoding is not None and self.encodings:
+            nearest = np.linalg.norm(np.asarray(self.encodings) - encoding, axis=1).min()
+            if nearest < DUPLICATE_DISTANCE:
+                encoding, reason = None, "Turn your head a little"
+        if encoding is None:
+            self.rejected += 1
+            self.status = f"{reason} ({self.count}/{self.target})"
+            return
+
+        path = os.path.join(self.folder, f"img_{self.count}.jpg")
+        cv2.imwrite(path, frame)
+        self.paths.append(path)
+        self.encodings.append(encoding)
+        self.status = f"Capturing {self.count}/{self.target}"
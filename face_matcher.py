@@ -0,0 +1,212 @@
+import sys
+from collections import namedtuple
+import numpy as np
+
+# Same cut-off face_recognition.compare_faces uses by default
+DEFAULT_TOLERANCE = 0.6
+
+# Per-identity thresholds are learned from each identity's spread and kept in this range
+MIN_TOLERANCE = 0.4
+SPREAD_FACTOR = 2.0
+
+# Number of medoids kept per identity next to its centroid. With the capture flow's
+# 20 images per identity, centroid + 1 medoid scans ~10x fewer rows per face before
+# the shortlist; identities with fewer images gain less (2.5x at 5 images)
+DEFAULT_MEDOIDS = 1
+
+# Identities whose prototypes are closest get their full encodings checked
+DEFAULT_SHORTLIST = 5
+
+Match = namedtuple("Match", ["name", "distance", "margin"])
+
+def _pairwise_sq_dist(queries, gallery, gallery_sq_norms=None):
+    if gallery_sq_norms is None:
+        gallery_sq_norms = np.einsum("ij,ij->i", gallery, gallery)
+    q_norms = np.einsum("ij,ij->i", queries, queries)
+
+    # |q - g|^2 = |q|^2 + |g|^2 - 2 q.g
+    sq_dist = q_norms[:, None] + gallery_sq_norms[None, :] - 2.0 * (queries @ gallery.T)
+    np.maximum(sq_dist, 0.0, out=sq_dist)
+    return sq_dist
+
+def build_prototype_index(encodings, names, medoids=DEFAULT_MEDOIDS, tolerance=DEFAULT_TOLERANCE):
+    """
+    Builds a compact per-identity index: one centroid plus a few medoids per identity,
+    and a distance threshold learned from that identity's own spread.
+    """
+    names = list(names)
+    if names:
+        matrix = np.asarray(encodings, dtype=np.float32).reshape(len(names), -1)
+    else:
+        matrix = np.empty((0, 128), dtype=np.float32)
+
+    # Group the rows by identity once instead of scanning every row per identity
+    identities, labels, counts = np.unique(np.array(names, dtype=str), return_inverse=True, return_counts=True)
+    identities = identities.tolist()
+    order = np.argsort(labels, kind="stable")
+    groups = np.split(matrix[order], np.cumsum(counts)[:-1]) if names else []
+
+    prototypes = []
+    prototype_labels = []
+    thresholds = []
+
+    for label, members in enumerate(groups):
+        centroid = members.mean(axis=0)
+        to_centroid = np.linalg.norm(members - centroid, axis=1)
+
+        # The member closest to the centroid is the medoid; the rest are
+        # farthest-point picks so the prototypes cover the identity's spread
+        chosen = [int(np.argmin(to_centroid))]
+        nearest = np.linalg.norm(members - members[chosen[0]], axis=1)
+        while len(chosen) < min(medoids, len(members)):
+            pick = int(np.argmax(nearest))
+            if nearest[pick] == 0:
+                break
+            chosen.append(pick)
+            nearest = np.minimum(nearest, np.linalg.norm(members - members[pick], axis=1))
+
+        prototypes.append(centroid)
+        prototypes.extend(members[chosen])
+        prototype_labels.extend([label] * (1 + len(chosen)))
+
+        radius = np.percentile(to_centroid, 95)
+        thresholds.append(np.clip(SPREAD_FACTOR * radius, MIN_TOLERANCE, tolerance))
+
+    return {
+        "identities": identities,
+        "prototypes": np.asarray(prototypes, dtype=np.float32).reshape(-1, matrix.shape[1]),
+        "prototype_labels": np.asarray(prototype_labels, dtype=np.int32),
+        "thresholds": np.asarray(thresholds, dtype=np.float32),
+    }
+
+class FaceMatcher:
+    """
+    Nearest-neighbour matcher over the whole gallery.
+    All encodings live in one contiguous float32 matrix (rows grouped by identity)
+    so every face in a frame is scored with a single matrix product.
+    When a prototype index is given, faces are first shortlisted against the
+    prototypes and only the shortlisted identities' encodings are checked.
+    """
+    def __init__(self, encodings, names, tolerance=DEFAULT_TOLERANCE, index=None, shortlist=DEFAULT_SHORTLIST):
+        names = list(names)
+        identities = sorted(set(names))
+
+        if names:
+            matrix = np.asarray(encodings, dtype=np.float32).reshape(len(names), -1)
+        else:
+            matrix = np.empty((0, 128), dtype=np.float32)
+
+        label_of = {name: i for i, name in enumerate(identities)}
+        labels = np.array([label_of[name] for name in names], dtype=np.int32)
+
+        # Group rows by identity so per-identity minimums are one reduceat call
+        order = np.argsort(labels, kind="stable")
+        self._setup(np.ascontiguousarray(matrix[order]), labels[order], identities, tolerance, shortlist)
+        if index is not None:
+            self._load_index(index, label_of)
+
+    @classmethod
+    def from_gallery(cls, gallery, tolerance=DEFAULT_TOLERANCE, shortlist=DEFAULT_SHORTLIST):
+        # Uses the gallery's memmapped arrays directly; its rows are already grouped by identity
+        matcher = cls.__new__(cls)
+        matcher._setup(gallery.embeddings, gallery.labels, gallery.identities, tolerance, shortlist, gallery.sq_norms)
+
+        index = gallery.index
+        if index is not None:
+            thresholds = np.asarray(index["thresholds"])
+            matcher.thresholds = np.where(np.isnan(thresholds), tolerance, thresholds).astype(np.float32)
+            if len(set(np.asarray(index["prototype_labels"]).tolist())) == len(gallery.identities):
+                matcher._set_prototypes(index["prototypes"], index["prototype_labels"])
+        return matcher
+
+    def _setup(self, embeddings, labels, identities, tolerance, shortlist, sq_norms=None):
+        self.tolerance = tolerance
+        self.shortlist = shortlist
+        self.identities = list(identities)
+
+        self.embeddings = embeddings
+        self.labels = labels
+        self.sq_norms = sq_norms if sq_norms is not None else np.einsum("ij,ij->i", embeddings, embeddings)
+        self.offsets = np.searchsorted(self.labels, np.arange(len(self.identities)))
+        self.ends = np.append(self.offsets[1:], len(self.labels))
+
+        self.thresholds = np.full(len(self.identities), tolerance, dtype=np.float32)
+        self.prototypes = None
+
+    def _load_index(self, index, label_of):
+        # Remap the index onto this gallery; identities the gallery lacks are ignored
+        index_labels = np.array([label_of.get(name, -1) for name in index["identities"]], dtype=np.int32)
+        proto_labels = index_labels[np.asarray(index["prototype_labels"], dtype=np.int32)]
+        keep = proto_labels >= 0
+
+        covered = set(proto_labels[keep].tolist())
+        if len(covered) != len(self.identities):
+            print("[WARN] Prototype index is out of date, matching against full gallery.", file=sys.stderr)
+            return
+
+        for index_label, label in enumerate(index_labels):
+            if label >= 0:
+                self.thresholds[label] = index["thresholds"][index_label]
+
+        self._set_prototypes(np.asarray(index["prototypes"], dtype=np.float32)[keep], proto_labels[keep])
+
+    def _set_prototypes(self, prototypes, prototype_labels):
+        order = np.argsort(prototype_labels, kind="stable")
+        self.prototypes = np.ascontiguousarray(np.asarray(prototypes, dtype=np.float32)[order])
+        self.prototype_labels = np.asarray(prototype_labels)[order]
+        self.prototype_sq_norms = np.einsum("ij,ij->i", self.prototypes, self.prototypes)
+        self.prototype_offsets = np.searchsorted(self.prototype_labels, np.arange(len(self.identities)))
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def identity_distances(self, face_encodings):
+        # Returns a (faces x identities) matrix of the distance to each identity's closest image.
+        # Identities that were not shortlisted are left at infinity.
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(len(face_encodings), -1)
+
+        if self.prototypes is None or len(self.identities) <= self.shortlist:
+            sq_dist = _pairwise_sq_dist(queries, self.embeddings, self.sq_norms)
+            return np.sqrt(np.minimum.reduceat(sq_dist, self.offsets, axis=1))
+
+        proto_sq = _pairwise_sq_dist(queries, self.prototypes, self.prototype_sq_norms)
+        proto_per_identity = np.minimum.reduceat(proto_sq, self.prototype_offsets, axis=1)
+        candidates = np.argpartition(proto_per_identity, self.shortlist - 1, axis=1)[:, :self.shortlist]
+
+        distances = np.full((len(queries), len(self.identities)), np.inf, dtype=np.float32)
+        for face, labels in enumerate(candidates):
+            labels = np.sort(labels)
+            sizes = self.ends[labels] - self.offsets[labels]
+            rows = np.concatenate([np.arange(self.offsets[l], self.ends[l]) for l in labels])
+            starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+
+            sq_dist = _pairwise_sq_dist(queries[face:face + 1], self.embeddings[rows], self.sq_norms[rows])
+            distances[face, labels] = np.sqrt(np.minimum.reduceat(sq_dist[0], starts))
+        return distances
+
+    def match(self, face_encodings):
+        """
+        Returns one Match(name, distance, margin) per face encoding.
+        margin is how much closer the best identity is than the runner-up.
+        """
+        if len(face_encodings) == 0:
+            return []
+        if not self.identities:
+            return [Match("Unknown", float("inf"), 0.0) for _ in face_encodings]
+
+        distances = self.identity_distances(face_encodings)
+        best = np.argmin(distances, axis=1)
+        rows = np.arange(len(best))
+        best_dist = distances[rows, best]
+
+        if len(self.identities) > 1:
+            runner_up = np.partition(distances, 1, axis=1)[:, 1]
+            margins = runner_up - best_dist
+        else:
+            margins = np.full(len(best), np.inf, dtype=np.float32)
+
+        results = []
+        for idx, dist, margin in zip(best, best_dist, margins):
+            name = self.identities[idx] if dist <= self.thresholds[idx] else "Unknown"
+            results.append(Match(name, float(dist), float(margin)))
+        return results
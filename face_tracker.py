@@ -0,0 +1,119 @@
+import itertools
+
+class Track:
+    """
+    A face followed across frames. Identity comes from the votes of every
+    embedding taken while the face was tracked, not from a single frame.
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, box):
+        self.id = next(Track._ids)
+        self.box = box # (top, right, bottom, left)
+        self.votes = {}
+        self.confidence = 0.0
+        self.distance = None
+        self.missed = 0
+        self.age = 0
+
+    @property
+    def identity(self):
+        # "Unknown" only wins when nothing matched: one badly posed frame must not outvote a real match
+        known = {name: votes for name, votes in self.votes.items() if name != "Unknown"}
+        if not known:
+            return "Unknown"
+        return max(known, key=known.get)
+
+    def add_observation(self, match):
+        self.votes[match.name] = self.votes.get(match.name, 0) + 1
+        self.distance = match.distance
+        # Unknown faces are re-checked sooner; they may just have been badly posed
+        self.confidence = 1.0 if match.name != "Unknown" else 0.6
+
+def iou(a, b):
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    inter = max(0, right - left) * max(0, bottom - top)
+    if inter == 0:
+        return 0.0
+    area_a = (a[1] - a[3]) * (a[2] - a[0])
+    area_b = (b[1] - b[3]) * (b[2] - b[0])
+    return inter / float(area_a + area_b - inter)
+
+def _contains(region, box):
+    # True when the box's centre lies inside the region
+    cy = (box[0] + box[2]) / 2.0
+    cx = (box[1] + box[3]) / 2.0
+    return region[0] <= cy <= region[2] and region[3] <= cx <= region[1]
+
+class FaceTracker:
+    """
+    Associates detected boxes with existing tracks by IoU so a face that stays
+    in front of the camera only has to be embedded when it first shows up or
+    when its identity confidence has decayed.
+    """
+    def __init__(self, iou_threshold=0.3, max_missed=2, confidence_decay=0.85, min_confidence=0.5):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.confidence_decay = confidence_decay
+        self.min_confidence = min_confidence
+        self.tracks = []
+
+    def reset(self):
+        self.tracks = []
+
+    def update(self, boxes, scanned=None):
+        """
+        Feeds one round of detections. Returns the track for each box (same order)
+        and whether any track was created or lost this round.
+        scanned lists the regions detection ran on (None for the whole frame);
+        tracks outside them are left as they are.
+        """
+        # Greedy association, best overlap first
+        pairs = []
+        for t, track in enumerate(self.tracks):
+            for b, box in enumerate(boxes):
+                overlap = iou(track.box, box)
+                if overlap >= self.iou_threshold:
+                    pairs.append((overlap, t, b))
+        pairs.sort(reverse=True)
+
+        assigned = [None] * len(boxes)
+        used = set()
+        for _, t, b in pairs:
+            if t in used or assigned[b] is not None:
+                continue
+            used.add(t)
+            assigned[b] = self.tracks[t]
+
+        changed = False
+        survivors = []
+        for t, track in enumerate(self.tracks):
+            if t in used:
+                track.missed = 0
+                survivors.append(track)
+            elif scanned is not None and not any(_contains(region, track.box) for region in scanned):
+                survivors.append(track)
+            else:
+                track.missed += 1
+                if track.missed <= self.max_missed:
+                    survivors.append(track)
+                else:
+                    changed = True
+
+        for b, box in enumerate(boxes):
+            if assigned[b] is None:
+                assigned[b] = Track(box)
+                survivors.append(assigned[b])
+                changed = True
+            else:
+                track = assigned[b]
+                track.box = box
+                track.age += 1
+                track.confidence *= self.confidence_decay
+
+        self.tracks = survivors
+        return assigned, changed
+
+    def needs_embedding(self, track):
+        return not track.votes or track.confidence < self.min_confidence
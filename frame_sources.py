@@ -0,0 +1,53 @@
+import os
+import time
+import cv2
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+def is_live(source):
+    # Webcams and network streams run on wall-clock time; files and folders have their own timeline
+    return _camera_index(source) is not None or "://" in str(source)
+
+def _camera_index(source):
+    if isinstance(source, int):
+        return source
+    if isinstance(source, str) and source.isdigit():
+        return int(source)
+    return None
+
+def open_capture(source):
+    index = _camera_index(source)
+    capture = cv2.VideoCapture(index if index is not None else str(source))
+    if not capture.isOpened():
+        raise IOError(f"Cannot open video source {source!r}")
+    return capture
+
+def iter_frames(source, mirror=False):
+    """
+    Yields (timestamp, BGR frame) from a webcam index, video file, stream URL or image directory.
+    Timestamps are wall-clock seconds for live sources, the position in the video for files,
+    and the image's position in the sorted folder for directories.
+    """
+    if isinstance(source, str) and os.path.isdir(source):
+        names = sorted(name for name in os.listdir(source) if name.lower().endswith(IMAGE_EXTENSIONS))
+        for i, name in enumerate(names):
+            frame = cv2.imread(os.path.join(source, name))
+            if frame is None:
+                continue
+            yield float(i), cv2.flip(frame, 1) if mirror else frame
+        return
+
+    live = is_live(source)
+    capture = open_capture(source)
+    try:
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                if live:
+                    time.sleep(0.01) # Camera or stream hiccup; keep waiting for frames
+                    continue
+                break
+            timestamp = time.time() if live else capture.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            yield timestamp, cv2.flip(frame, 1) if mirror else frame
+    finally:
+        capture.release()
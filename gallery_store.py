@@ -0,0 +1,303 @@
+import os
+import sys
+import json
+import time
+import pickle
+import struct
+import tempfile
+import argparse
+import numpy as np
+
+from face_matcher import build_prototype_index
+
+DEFAULT_GALLERY_FILE = "encodings.gallery"
+LEGACY_PICKLE_FILE = "encodings.pickle"
+
+# `path` (e.g. encodings.gallery) is a small pointer file naming the current data file,
+# encodings.<n>.gallery. Each write goes to a new data file and then swaps the pointer:
+# readers keep their old file memory-mapped, and Windows cannot replace or delete a
+# mapped file. Older data files are removed once nothing maps them any more.
+POINTER_MAGIC = b"SGGALPTR"
+
+# Data file layout:
+#   header (HEADER_SIZE bytes): magic, version, dimension, row count, table offset/length
+#   array sections, each aligned to SECTION_ALIGN bytes (embeddings first, so it can be memmapped as is)
+#   JSON table describing the sections plus the identity list
+MAGIC = b"SGGALLRY"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIQQ")
+HEADER_SIZE = 64
+SECTION_ALIGN = 64
+
+class GalleryFormatError(Exception):
+    pass
+
+class Gallery:
+    """
+    A loaded gallery. Array sections are read-only np.memmap views of the file,
+    so loading costs the same no matter how many people are enrolled.
+    Rows are grouped by identity: labels is sorted.
+    """
+    def __init__(self, path, version, dim, sections, identities):
+        self.path = path
+        self.version = version
+        self.dim = dim
+        self.identities = identities
+        self._sections = sections
+
+        self.embeddings = sections["embeddings"]
+        self.labels = sections["labels"]
+        self.sq_norms = sections["sq_norms"]
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    @property
+    def names(self):
+        return [self.identities[label] for label in self.labels]
+
+    @property
+    def sources(self):
+        # Source image of every row; only needed for retraining, so parsed on demand
+        return json.loads(self._sections["sources"].tobytes().decode("utf-8"))
+
+    @property
+    def index(self):
+        if "prototypes" not in self._sections:
+            return None
+        return {
+            "identities": self.identities,
+            "prototypes": self._sections["prototypes"],
+            "prototype_labels": self._sections["prototype_labels"],
+            "thresholds": self._sections["thresholds"],
+        }
+
+def _data_path(path, number):
+    root, ext = os.path.splitext(path)
+    return f"{root}.{number}{ext}"
+
+def _current_data_file(path):
+    # Returns (data file path, its number); number 0 is a gallery written as one plain file
+    with open(path, "rb") as f:
+        head = f.read(len(POINTER_MAGIC))
+        if head == MAGIC:
+            return path, 0
+        if head != POINTER_MAGIC:
+            raise GalleryFormatError(f"{path} is not a gallery file")
+        name = f.read().decode("utf-8").strip()
+    return os.path.join(os.path.dirname(path), name), _data_number(path, name)
+
+def _data_number(path, name):
+    # "encodings.7.gallery" -> 7; None for files that are not data files of this gallery
+    root, ext = os.path.splitext(os.path.basename(path))
+    number = name[len(root) + 1:len(name) - len(ext)]
+    if name.startswith(root + ".") and name.endswith(ext) and number.isdigit():
+        return int(number)
+    return None
+
+def _replace(src, dst, attempts=20):
+    # On Windows a reader that has dst open for a moment makes the rename fail; try again shortly
+    for attempt in range(attempts):
+        try:
+            os.replace(src, dst)
+            return
+        except PermissionError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.05)
+
+def _remove_old_data_files(path, current):
+    # Files still mapped by a camera or worker cannot be removed on Windows; a later write retries.
+    # Newer files are left alone: another process may have just written one
+    folder = os.path.dirname(path) or "."
+    for name in os.listdir(folder):
+        number = _data_number(path, name)
+        if number is not None and number < current:
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass
+
+def write_gallery(path, encodings, names, sources=None, index=None):
+    """
+    Writes a gallery atomically: the data goes to a new encodings.<n>.gallery file and
+    then the pointer at `path` is swapped, so readers only ever see the old or the new
+    gallery and the file they have mapped is never touched.
+    """
+    names = list(names)
+    sources = list(sources) if sources is not None else [""] * len(names)
+    identities = sorted(set(names))
+
+    if names:
+        matrix = np.asarray(encodings, dtype=np.float32).reshape(len(names), -1)
+    else:
+        matrix = np.empty((0, 128), dtype=np.float32)
+    label_of = {name: i for i, name in enumerate(identities)}
+    labels = np.array([label_of[name] for name in names], dtype=np.int32)
+
+    # Store rows grouped by identity so the matcher can use them without reordering
+    order = np.argsort(labels, kind="stable")
+    matrix = np.ascontiguousarray(matrix[order])
+    labels = labels[order]
+    sources = [sources[i] for i in order]
+
+    if index is None:
+        index = build_prototype_index(matrix, [identities[l] for l in labels])
+    index_labels = np.array([label_of.get(name, -1) for name in index["identities"]], dtype=np.int32)
+    prototype_labels = index_labels[np.asarray(index["prototype_labels"], dtype=np.int32)]
+    thresholds = np.full(len(identities), np.nan, dtype=np.float32)
+    for index_label, label in enumerate(index_labels):
+        if label >= 0:
+            thresholds[label] = index["thresholds"][index_label]
+    keep = prototype_labels >= 0
+
+    arrays = {
+        "embeddings": matrix,
+        "labels": labels,
+        "sq_norms": np.einsum("ij,ij->i", matrix, matrix).astype(np.float32),
+        "prototypes": np.asarray(index["prototypes"], dtype=np.float32).reshape(-1, matrix.shape[1])[keep],
+        "prototype_labels": prototype_labels[keep],
+        "thresholds": thresholds,
+        "sources": np.frombuffer(json.dumps(sources).encode("utf-8"), dtype=np.uint8),
+    }
+
+    number = _current_data_file(path)[1] + 1 if os.path.exists(path) else 1
+    data_path = _data_path(path, number)
+    # Temp names are unique, so processes writing at the same time never share one
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(data_path) + ".", dir=os.path.dirname(path) or ".")
+    with os.fdopen(fd, "wb") as f:
+        f.write(b"\0" * HEADER_SIZE)
+        table = {"identities": identities, "sections": {}}
+        for name, array in arrays.items():
+            f.write(b"\0" * (-f.tell() % SECTION_ALIGN))
+            table["sections"][name] = {
+                "offset": f.tell(),
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+            }
+            f.write(np.ascontiguousarray(array).tobytes())
+
+        table_bytes = json.dumps(table).encode("utf-8")
+        table_offset = f.tell()
+        f.write(table_bytes)
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, matrix.shape[1], len(matrix), table_offset, len(table_bytes)))
+        f.flush()
+        os.fsync(f.fileno())
+    _replace(tmp_path, data_path)
+
+    fd, pointer_tmp = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(path) + ".", dir=os.path.dirname(path) or ".")
+    with os.fdopen(fd, "wb") as f:
+        f.write(POINTER_MAGIC + os.path.basename(data_path).encode("utf-8"))
+        f.flush()
+        os.fsync(f.fileno())
+    _replace(pointer_tmp, path)
+    _remove_old_data_files(path, number)
+
+def append_to_gallery(path, encodings, names, sources=None):
+    """
+    Adds rows to a gallery. Only the index entries of the identities receiving rows are
+    rebuilt; everyone else's prototypes and thresholds are carried over as they are.
+    """
+    names = list(names)
+    sources = list(sources) if sources is not None else [""] * len(names)
+    if not names:
+        return
+    new_matrix = np.asarray(encodings, dtype=np.float32).reshape(len(names), -1)
+
+    old_index = None
+    if os.path.exists(path):
+        gallery = load_gallery(path)
+        # Copies, so the old file is no longer mapped once gallery goes out of scope
+        old_index = gallery.index
+        if old_index is not None:
+            old_index = {key: value if key == "identities" else np.array(value) for key, value in old_index.items()}
+        # Rows from images that are being replaced (same path) are dropped
+        replaced = set(source for source in sources if source)
+        old_sources = gallery.sources
+        old_names = gallery.names
+        old_rows = [i for i, source in enumerate(old_sources) if source not in replaced]
+        if any(old_names[i] not in names for i, source in enumerate(old_sources) if source in replaced):
+            old_index = None # Another identity lost rows; rebuild the whole index
+        matrix = np.concatenate([np.asarray(gallery.embeddings)[old_rows], new_matrix])
+        all_names = [old_names[i] for i in old_rows] + names
+        all_sources = [old_sources[i] for i in old_rows] + sources
+        del gallery
+    else:
+        matrix, all_names, all_sources = new_matrix, names, sources
+
+    if old_index is None:
+        write_gallery(path, matrix, all_names, all_sources)
+        return
+
+    touched = set(names)
+    rows = [i for i, name in enumerate(all_names) if name in touched]
+    fresh = build_prototype_index(matrix[rows], [all_names[i] for i in rows])
+
+    kept = [i for i, identity in enumerate(old_index["identities"]) if identity not in touched]
+    relabel = np.full(len(old_index["identities"]), -1, dtype=np.int32)
+    relabel[kept] = np.arange(len(kept), dtype=np.int32)
+    old_labels = relabel[np.asarray(old_index["prototype_labels"])]
+    keep_rows = old_labels >= 0
+
+    index = {
+        "identities": [old_index["identities"][i] for i in kept] + fresh["identities"],
+        "prototypes": np.concatenate([np.asarray(old_index["prototypes"])[keep_rows], fresh["prototypes"]]),
+        "prototype_labels": np.concatenate([old_labels[keep_rows], fresh["prototype_labels"] + len(kept)]),
+        "thresholds": np.concatenate([np.asarray(old_index["thresholds"])[kept], fresh["thresholds"]]),
+    }
+    write_gallery(path, matrix, all_names, all_sources, index)
+
+def load_gallery(path):
+    data_path = _current_data_file(path)[0]
+    if not os.path.exists(data_path):
+        # Replaced and removed by a writer between reading the pointer and opening the file
+        data_path = _current_data_file(path)[0]
+    path = data_path
+    with open(path, "rb") as f:
+        magic, version, dim, count, table_offset, table_length = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise GalleryFormatError(f"{path} is not a gallery file")
+        if version > VERSION:
+            raise GalleryFormatError(f"{path} has gallery version {version}, this build reads up to {VERSION}")
+        f.seek(table_offset)
+        table = json.loads(f.read(table_length).decode("utf-8"))
+
+    sections = {}
+    for name, section in table["sections"].items():
+        shape = tuple(section["shape"])
+        if 0 in shape:
+            # np.memmap cannot map zero bytes
+            sections[name] = np.empty(shape, dtype=section["dtype"])
+        else:
+            sections[name] = np.memmap(path, dtype=section["dtype"], mode="r", offset=section["offset"], shape=shape)
+
+    if sections["embeddings"].shape != (count, dim):
+        raise GalleryFormatError(f"{path} is truncated or corrupt")
+    return Gallery(path, version, dim, sections, table["identities"])
+
+def import_pickle(pickle_path, gallery_path):
+    """
+    One-time conversion of an old encodings.pickle into the gallery format.
+    """
+    # stderr, so the recognition CLI's JSON lines on stdout stay clean
+    print(f"[INFO] Importing {pickle_path} into {gallery_path}...", file=sys.stderr)
+    data = pickle.loads(open(pickle_path, "rb").read())
+    write_gallery(gallery_path, data["encodings"], data["names"], data.get("paths"), data.get("index"))
+
+def migrate_legacy_pickle(pickle_path, gallery_path):
+    # Imports the old pickle if there is one and no gallery has been written yet
+    if os.path.exists(gallery_path) or not os.path.exists(pickle_path):
+        return False
+    import_pickle(pickle_path, gallery_path)
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert an encodings.pickle file into the gallery format.")
+    parser.add_argument("pickle_path", nargs="?", default=LEGACY_PICKLE_FILE)
+    parser.add_argument("gallery_path", nargs="?", default=DEFAULT_GALLERY_FILE)
+    args = parser.parse_args()
+
+    import_pickle(args.pickle_path, args.gallery_path)
+    print("[INFO] Gallery saved.")
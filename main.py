@@ -1,16 +1,43 @@
 import customtkinter as ctk
+import tkinter as tk
 from tkinter import ttk, messagebox
 import cv2
 from PIL import Image, ImageTk
 import threading
 import time
 import os
+from datetime import datetime
 
+import metrics
 from database_manager import DatabaseManager
-from camera_service import CameraService
+from camera_manager import CameraManager
 from email_service import EmailService
 from encoder import Encoder
-from utils import speak, create_directory
+from utils import speak, get_speech_service, create_directory, remove_directory, PRIORITY_HIGH, PRIORITY_LOW
+
+# Students shown per page on the Class Dashboard
+STATS_PAGE_SIZE = 50
+
+# How often the user directory checks the database for changes made elsewhere
+USER_POLL_MS = 5000
+
+# Stage timings, FPS and queue depths: written to METRICS_FILE every METRICS_INTERVAL seconds,
+# and served for Prometheus on http://127.0.0.1:METRICS_HTTP_PORT/metrics if a port is set
+METRICS_FILE = "metrics.json"
+METRICS_INTERVAL = 10.0
+METRICS_HTTP_PORT = None
+METRICS_LOG = False # Also print the metrics to the console
+PROFILE_SECONDS = 10 # Length of the recognition loop profile taken with F12
+
+# Worker processes for detection and embedding; 0 runs recognition on a thread of this process.
+# Worth it on multi-core machines when classroom frames hold many faces.
+RECOGNITION_WORKERS = 0
+
+# Cameras to recognize from: webcam indexes, video files or stream URLs (e.g. one per door).
+# The first is previewed on the Home page and used for enrollment.
+CAMERA_SOURCES = [0]
+# Recognized frames per second per camera (None: as often as the machine allows, shared fairly)
+CAMERA_FPS_BUDGETS = None
 
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("blue")
@@ -24,9 +51,12 @@ class App(ctk.CTk):
 
         # Initialize Managers
         self.db = DatabaseManager()
-        self.email_service = EmailService()
-        self.camera = CameraService(detection_callback=self.on_face_detected)
+        self.email_service = EmailService(self.db)
+        self.cameras = CameraManager(CAMERA_SOURCES, detection_callback=self.on_face_detected,
+                                     fps_budgets=CAMERA_FPS_BUDGETS, workers=RECOGNITION_WORKERS)
+        self.camera = self.cameras.primary
         self.encoder = Encoder()
+        self.metrics_reporter = self.start_metrics()
 
         # State
         self.pending_attendance = set() # Set of IDs
@@ -44,8 +74,20 @@ class App(ctk.CTk):
         self.show_frame("Home")
         
         # Start Camera
-        self.camera.start()
+        self.cameras.start()
         self.update_camera_feed()
+        self.poll_user_directory()
+
+        # F12: profile the recognition loop for PROFILE_SECONDS (saved as profile-recognition-*.prof)
+        self.bind("<F12>", lambda event: self.camera.request_profile(PROFILE_SECONDS))
+
+    def start_metrics(self):
+        sinks = [metrics.JsonFileSink(METRICS_FILE)]
+        if METRICS_LOG:
+            sinks.append(metrics.LogSink())
+        if METRICS_HTTP_PORT:
+            sinks.append(metrics.HttpSink(port=METRICS_HTTP_PORT))
+        return metrics.MetricsReporter(sinks, METRICS_INTERVAL)
 
     def create_sidebar(self):
         self.sidebar_frame = ctk.CTkFrame(self, width=200, corner_radius=0)
@@ -75,9 +117,11 @@ class App(ctk.CTk):
         self.home_frame.grid_columnconfigure(1, weight=1)
         self.home_frame.grid_rowconfigure(0, weight=1)
 
-        # Camera Feed
-        self.camera_label = ctk.CTkLabel(self.home_frame, text="")
-        self.camera_label.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
+        # Camera Feed: one PhotoImage, repainted in place with each new frame
+        self.camera_photo = ImageTk.PhotoImage(Image.new("RGB", self.camera.display_size))
+        self.camera_seq = 0
+        self.camera_label = tk.Label(self.home_frame, image=self.camera_photo, borderwidth=0, bg="black")
+        self.camera_label.grid(row=0, column=0, padx=10, pady=10)
 
         # Pending List Panel
         self.pending_frame = ctk.CTkFrame(self.home_frame)
@@ -94,6 +138,18 @@ class App(ctk.CTk):
         self.pages["Class"] = self.class_frame
         
         ctk.CTkLabel(self.class_frame, text="Class Dashboard", font=("Arial", 24, "bold")).pack(pady=20)
+
+        # Date range filter
+        self.filter_frame = ctk.CTkFrame(self.class_frame, fg_color="transparent")
+        self.filter_frame.pack(padx=20, fill="x")
+
+        self.entry_from = ctk.CTkEntry(self.filter_frame, placeholder_text="From (YYYY-MM-DD)")
+        self.entry_from.pack(side="left", padx=5)
+
+        self.entry_to = ctk.CTkEntry(self.filter_frame, placeholder_text="To (YYYY-MM-DD)")
+        self.entry_to.pack(side="left", padx=5)
+
+        ctk.CTkButton(self.filter_frame, text="Apply Filter", command=self.apply_stats_filter).pack(side="left", padx=5)
         
         # Treeview for stats
         self.tree_frame = ctk.CTkFrame(self.class_frame)
@@ -107,6 +163,16 @@ class App(ctk.CTk):
         
         self.tree.pack(fill="both", expand=True)
         
+        # Paging
+        self.stats_page = 0
+        self.page_frame = ctk.CTkFrame(self.class_frame, fg_color="transparent")
+        self.page_frame.pack()
+
+        ctk.CTkButton(self.page_frame, text="< Prev", width=80, command=lambda: self.change_stats_page(-1)).pack(side="left", padx=5)
+        self.page_label = ctk.CTkLabel(self.page_frame, text="")
+        self.page_label.pack(side="left", padx=10)
+        ctk.CTkButton(self.page_frame, text="Next >", width=80, command=lambda: self.change_stats_page(1)).pack(side="left", padx=5)
+
         # Refresh Button
         ctk.CTkButton(self.class_frame, text="Refresh Stats", command=self.load_class_stats).pack(pady=10)
 
@@ -138,7 +204,11 @@ class App(ctk.CTk):
         self.entry_email_p = ctk.CTkEntry(self.form_frame, placeholder_text="Parent Email")
         self.entry_email_p.pack(pady=5, padx=10, fill="x")
         
-        ctk.CTkButton(self.form_frame, text="Capture Photos & Train", command=self.start_capture_flow).pack(pady=20, padx=10, fill="x")
+        ctk.CTkButton(self.form_frame, text="Capture Photos & Train", command=self.start_capture_flow).pack(pady=(20, 5), padx=10, fill="x")
+
+        # Enrollment hints ("Move closer", "Hold still", ...); the video is not shown on this page
+        self.capture_status_label = ctk.CTkLabel(self.form_frame, text="")
+        self.capture_status_label.pack(pady=(0, 10))
 
         # Manage List
         self.manage_frame = ctk.CTkFrame(self.teacher_frame)
@@ -161,6 +231,7 @@ class App(ctk.CTk):
             frame.grid_forget()
         self.pages[page_name].grid(row=0, column=1, sticky="nsew")
         
+        self.camera.set_display_enabled(page_name == "Home")
         if page_name == "Home":
             self.camera.set_mode("attendance")
         elif page_name == "Teacher":
@@ -169,14 +240,23 @@ class App(ctk.CTk):
             self.load_class_stats()
 
     def update_camera_feed(self):
-        frame = self.camera.get_frame()
-        if frame is not None:
-            ctk_img = ctk.CTkImage(light_image=frame, dark_image=frame, size=(640, 480))
-            self.camera_label.configure(image=ctk_img)
-            self.camera_label.image = ctk_img
+        # The camera thread already scaled and converted the frame; only new frames are painted
+        if self.pages["Home"].winfo_ismapped():
+            self.camera_seq, frame = self.camera.acquire_display_frame(self.camera_seq)
+            if frame is not None:
+                try:
+                    self.camera_photo.paste(Image.fromarray(frame))
+                finally:
+                    self.camera.release_display_frame()
         
         self.after(30, self.update_camera_feed)
 
+    def poll_user_directory(self):
+        # Picks up users added or removed by other processes (e.g. another kiosk on the same DB)
+        if self.db.users.refresh_if_changed() and self.pages["Teacher"].winfo_ismapped():
+            self.load_user_list()
+        self.after(USER_POLL_MS, self.poll_user_directory)
+
     def on_face_detected(self, name):
         if name == "Unknown":
             return
@@ -193,13 +273,7 @@ class App(ctk.CTk):
             if current_time - self.last_spoken_time[user_id] < 10: # 10 seconds cooldown
                 return
         
-        # Fetch user details
-        user = self.db.get_user_by_id(user_id) # Need to implement this in DB
-        # Wait, I didn't implement get_user_by_id in DB manager. 
-        # I'll fetch all users and filter, or just add the method.
-        # For now, let's assume I can get role. 
-        # I'll do a quick query here or cache it.
-        # Let's add a helper method in this class to get role from ID.
+        # Fetch user details (in-memory directory, no SQL)
         role = self.get_role_by_id(user_id)
         
         if not role:
@@ -211,26 +285,22 @@ class App(ctk.CTk):
             if user_id not in self.pending_attendance:
                 # Check if already marked today in DB
                 if self.db.check_attendance_today(user_id, time.strftime("%Y-%m-%d")):
-                    speak(f"{name}, you are already marked present.")
+                    speak(f"{name}, you are already marked present.", PRIORITY_LOW)
                 else:
                     self.pending_attendance.add(user_id)
                     self.update_pending_list()
-                    speak(f"Welcome {name}")
+                    # Students arriving together are welcomed in one announcement
+                    get_speech_service().say_names("Welcome {names}", name)
         
         elif role == "Teacher":
             if self.pending_attendance:
-                speak(f"Hello {name}. Saving attendance.")
+                speak(f"Hello {name}. Saving attendance.", PRIORITY_HIGH)
                 self.save_attendance()
             else:
-                speak(f"Hello {name}. No pending attendance.")
+                speak(f"Hello {name}. No pending attendance.", PRIORITY_HIGH)
 
     def get_role_by_id(self, user_id):
-        # Inefficient but works for small app
-        users = self.db.get_all_users()
-        for u in users:
-            if str(u[0]) == str(user_id):
-                return u[2]
-        return None
+        return self.db.users.role_of(user_id)
 
     def update_pending_list(self):
         self.pending_listbox.configure(state="normal")
@@ -240,18 +310,41 @@ class App(ctk.CTk):
         self.pending_listbox.configure(state="disabled")
 
     def save_attendance(self):
-        # Commit to DB
         present_ids = list(self.pending_attendance)
-        for uid in present_ids:
-            self.db.mark_attendance(uid)
-        
-        # Send Emails
-        self.email_service.process_attendance_emails(present_ids)
-        
+
         # Clear List
         self.pending_attendance.clear()
         self.update_pending_list()
-        messagebox.showinfo("Success", "Attendance Saved and Emails Sent!")
+
+        def _save():
+            # Commit to DB: attendance and its emails in one transaction for the whole class
+            date_str = datetime.now().strftime("%Y-%m-%d")
+            try:
+                # Planned inside the transaction, so students marked by an earlier save are not reported absent
+                emails = []
+                def plan(absent_students):
+                    emails.extend(self.email_service.plan_attendance_emails(present_ids, date_str, absent_students))
+                    return emails
+                inserted, already = self.db.mark_attendance_bulk(present_ids, date_str=date_str, outbox=plan)
+            except Exception as e:
+                # Nothing was committed; put the class back so the next save includes it
+                print(f"[WARN] Saving attendance failed: {e}")
+                self.after(0, lambda err=e: self._restore_pending(present_ids, err))
+                return
+
+            # Send Emails (in the background, from the outbox)
+            self.email_service.dispatcher.wake()
+
+            message = f"Attendance Saved ({len(inserted)} new, {len(already)} already marked) and {len(emails)} Emails Queued!"
+            self.after(0, lambda: messagebox.showinfo("Success", message))
+
+        # Keeps the UI (and the camera callback that triggers this) responsive while SQLite commits
+        threading.Thread(target=_save, daemon=True).start()
+
+    def _restore_pending(self, present_ids, error):
+        self.pending_attendance.update(present_ids)
+        self.update_pending_list()
+        messagebox.showerror("Error", f"Attendance was not saved ({error}). The students are still pending; try again.")
 
     # --- Teacher Page Logic ---
     def start_capture_flow(self):
@@ -265,35 +358,54 @@ class App(ctk.CTk):
             messagebox.showerror("Error", "ID and Name are required!")
             return
             
-        # Add to DB
-        if self.db.add_user(uid, name, role, email_s, email_p):
-            # Create dataset folder
-            folder_name = f"{uid}_{name}"
-            folder_path = os.path.join("dataset", folder_name)
-            create_directory(folder_path)
-            
-            # Start Camera Capture
-            self.camera.start_capture_session(folder_path, self.on_capture_complete)
-            messagebox.showinfo("Info", "Look at the camera. Capturing 20 photos...")
-        else:
+        if self.db.users.get(uid) is not None:
             messagebox.showerror("Error", "User ID already exists!")
+            return
 
-    def on_capture_complete(self):
-        # Run Encoder
-        self.after(0, lambda: messagebox.showinfo("Processing", "Training Model... Please wait."))
-        
-        def _train():
-            self.encoder.encode_faces()
-            self.camera.load_encodings() # Reload in camera
-            self.after(0, lambda: messagebox.showinfo("Success", "Training Complete! User Added."))
-            self.after(0, self.load_user_list)
-            
-        threading.Thread(target=_train, daemon=True).start()
+        # Create dataset folder; an existing one holds someone's photos, which must not be mixed in or deleted
+        folder_name = f"{uid}_{name}"
+        folder_path = os.path.join("dataset", folder_name)
+        if os.path.exists(folder_path):
+            messagebox.showerror("Error", f"{folder_path} already exists. Remove it first or use another ID.")
+            return
+        create_directory(folder_path)
+
+        # Start Camera Capture once the dialog is closed, so the enrollment timeout does not run while it is open
+        messagebox.showinfo("Info", "Look at the camera. 20 photos will be taken; follow the hints below the button.")
+        user = (uid, name, role, email_s, email_p)
+        self.camera.start_capture_session(folder_path, lambda session: self.on_capture_complete(session, user))
+        self.update_capture_status()
+
+    def update_capture_status(self):
+        session = self.camera.enrollment
+        if session is None:
+            return
+        self.capture_status_label.configure(text=session.status)
+        if self.camera.capture_session_active:
+            self.after(200, self.update_capture_status)
+
+    def on_capture_complete(self, session, user):
+        # Called on the enrollment thread; the photos are already encoded
+        # The user is added only now, so a failed enrollment leaves nothing behind to retry around
+        if not session.succeeded:
+            session.discard()
+            self.after(0, lambda: messagebox.showerror("Error", f"Only {session.count} good photo(s) captured. Please try again."))
+            return
+        if not self.db.add_user(*user):
+            session.discard()
+            self.after(0, lambda: messagebox.showerror("Error", "User ID already exists!"))
+            return
+
+        # No retrain: the new encodings go straight into the gallery
+        self.encoder.add_encodings(session.encodings, [session.identity] * session.count, session.paths)
+        self.cameras.load_encodings() # Reload in camera
+        self.after(0, lambda: messagebox.showinfo("Success", f"User Added with {session.count} photos."))
+        self.after(0, self.load_user_list)
 
     def load_user_list(self):
         self.user_list_text.configure(state="normal")
         self.user_list_text.delete("1.0", "end")
-        users = self.db.get_all_users()
+        users = self.db.users.all()
         for u in users:
             self.user_list_text.insert("end", f"{u[0]} | {u[1]} | {u[2]}\n")
         self.user_list_text.configure(state="disabled")
@@ -301,16 +413,69 @@ class App(ctk.CTk):
     def delete_user(self):
         uid = self.delete_id_entry.get()
         if uid:
+            user = self.db.users.get(uid)
+            if user is None:
+                messagebox.showerror("Error", f"No user with ID {uid}.")
+                return
+
+            # The photos must go too, or the next retrain would enroll them again
+            folder_path = os.path.join("dataset", f"{user.id}_{user.name}")
+            if not messagebox.askyesno("Confirm", f"Delete {user.name} ({uid}) and their enrollment photos? This cannot be undone."):
+                return
+
             self.db.delete_user(uid)
             self.load_user_list()
+            remove_directory(folder_path)
             messagebox.showinfo("Deleted", f"User {uid} deleted.")
 
+            def _retrain():
+                self.encoder.encode_faces(incremental=True)
+                self.cameras.load_encodings()
+
+            threading.Thread(target=_retrain, daemon=True).start()
+
     # --- Class Page Logic ---
+    def apply_stats_filter(self):
+        self.stats_page = 0
+        self.load_class_stats()
+
+    def change_stats_page(self, step):
+        pages = max(1, -(-self.db.count_students() // STATS_PAGE_SIZE))
+        self.stats_page = min(max(0, self.stats_page + step), pages - 1)
+        self.load_class_stats()
+
+    def _filter_date(self, entry, label):
+        # Dates are compared as text in SQL, so they must be exactly YYYY-MM-DD; "2026-1-5" becomes "2026-01-05"
+        text = entry.get().strip()
+        if not text:
+            return None
+        try:
+            return datetime.strptime(text, "%Y-%m-%d").strftime("%Y-%m-%d")
+        except ValueError:
+            messagebox.showerror("Error", f"{label} date must be YYYY-MM-DD, e.g. 2026-10-01.")
+            raise
+
     def load_class_stats(self):
+        try:
+            start_date = self._filter_date(self.entry_from, "From")
+            end_date = self._filter_date(self.entry_to, "To")
+        except ValueError:
+            return
+
         for item in self.tree.get_children():
             self.tree.delete(item)
-            
-        stats = self.db.get_attendance_stats()
+
+        pages = max(1, -(-self.db.count_students() // STATS_PAGE_SIZE))
+        self.stats_page = min(self.stats_page, pages - 1)
+        self.page_label.configure(text=f"Page {self.stats_page + 1} of {pages}")
+
+        # Cached in DatabaseManager until attendance changes, so refreshing is cheap
+        stats = self.db.get_attendance_stats(
+            start_date=start_date,
+            end_date=end_date,
+            limit=STATS_PAGE_SIZE,
+            offset=self.stats_page * STATS_PAGE_SIZE,
+        )
         for s in stats:
             # Highlight if percentage < 75
             tags = ()
@@ -322,7 +487,10 @@ class App(ctk.CTk):
         self.tree.tag_configure('low_attendance', background='#ffcccc', foreground='black') # Light red
 
     def on_closing(self):
-        self.camera.stop()
+        self.cameras.stop()
+        self.metrics_reporter.stop()
+        self.email_service.close()
+        get_speech_service().close()
         self.destroy()
 
 if __name__ == "__main__":
@@ -0,0 +1,314 @@
+import os
+import re
+import sys
+import json
+import time
+import pstats
+import cProfile
+import functools
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Durations kept per timer for the percentiles; older ones roll out
+TIMER_WINDOW = 1024
+DEFAULT_REPORT_INTERVAL = 10.0
+
+class Timer:
+    """
+    Durations of one stage: total count and time, plus percentiles over the last TIMER_WINDOW calls.
+    """
+    def __init__(self, window=TIMER_WINDOW):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+            self.total += seconds
+
+    def time(self):
+        return _TimerContext(self)
+
+    def snapshot(self):
+        with self.lock:
+            samples = sorted(self.samples)
+            count, total = self.count, self.total
+        stats = {"count": count, "total_s": round(total, 6)}
+        if samples:
+            for label, q in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+                stats[label] = round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000.0, 3)
+            stats["max_ms"] = round(samples[-1] * 1000.0, 3)
+        return stats
+
+class _TimerContext:
+    __slots__ = ("timer", "started")
+
+    def __init__(self, timer):
+        self.timer = timer
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.observe(time.perf_counter() - self.started)
+        return False
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+class MetricsRegistry:
+    """
+    Named timers, counters and gauges. Gauges are functions read when a snapshot is taken,
+    e.g. a queue's qsize, so the code being measured does no extra work for them.
+    """
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def timer(self, name):
+        timer = self.timers.get(name)
+        if timer is None:
+            with self.lock:
+                timer = self.timers.setdefault(name, Timer())
+        return timer
+
+    def counter(self, name):
+        counter = self.counters.get(name)
+        if counter is None:
+            with self.lock:
+                counter = self.counters.setdefault(name, Counter())
+        return counter
+
+    def gauge(self, name, fn):
+        # Registering a name again replaces the function, e.g. when a service is recreated
+        with self.lock:
+            self.gauges[name] = fn
+
+    def snapshot(self):
+        with self.lock:
+            timers = dict(self.timers)
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+
+        values = {}
+        for name, fn in gauges.items():
+            try:
+                values[name] = fn()
+            except Exception as e:
+                # A gauge must never take the reporter down (e.g. a database that is locked right now)
+                values[name] = None
+                print(f"[WARN] Gauge {name} failed: {e}", file=sys.stderr)
+        return {
+            "timestamp": time.time(),
+            "timers": {name: timer.snapshot() for name, timer in sorted(timers.items())},
+            "counters": {name: counter.value for name, counter in sorted(counters.items())},
+            "gauges": dict(sorted(values.items())),
+        }
+
+# The process-wide registry that the services report into
+REGISTRY = MetricsRegistry()
+
+def timer(name):
+    return REGISTRY.timer(name)
+
+def counter(name):
+    return REGISTRY.counter(name)
+
+def gauge(name, fn):
+    REGISTRY.gauge(name, fn)
+
+def timed(name):
+    """
+    Decorator recording every call of the function in the timer `name`.
+    """
+    stage = REGISTRY.timer(name)
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                stage.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+# --- Sinks ---
+class LogSink:
+    """
+    Prints one line per timer, counter and gauge.
+    """
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def emit(self, snapshot):
+        stream = self.stream or sys.stderr
+        for name, stats in snapshot["timers"].items():
+            if stats["count"]:
+                print(f"[METRICS] {name}: n={stats['count']} p50={stats.get('p50_ms')}ms "
+                      f"p95={stats.get('p95_ms')}ms max={stats.get('max_ms')}ms", file=stream)
+        for name, value in snapshot["counters"].items():
+            print(f"[METRICS] {name}: {value}", file=stream)
+        for name, value in snapshot["gauges"].items():
+            print(f"[METRICS] {name}: {value}", file=stream)
+
+class JsonFileSink:
+    """
+    Keeps the latest snapshot in a JSON file, replaced atomically so readers never see half a file.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, snapshot):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+def _prometheus_name(name):
+    return "smartguard_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+def prometheus_text(snapshot):
+    # Prometheus text exposition format: timers as summaries, counters and gauges as-is
+    lines = []
+    for name, stats in snapshot["timers"].items():
+        metric = _prometheus_name(name) + "_seconds"
+        lines.append(f"# TYPE {metric} summary")
+        for label, q in (("p50_ms", "0.5"), ("p95_ms", "0.95"), ("p99_ms", "0.99")):
+            if label in stats:
+                lines.append(f'{metric}{{quantile="{q}"}} {stats[label] / 1000.0}')
+        lines.append(f"{metric}_sum {stats['total_s']}")
+        lines.append(f"{metric}_count {stats['count']}")
+    for name, value in snapshot["counters"].items():
+        metric = _prometheus_name(name) + "_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    for name, value in snapshot["gauges"].items():
+        if isinstance(value, (int, float)):
+            metric = _prometheus_name(name)
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+class HttpSink:
+    """
+    Serves the registry on a local port: /metrics in Prometheus text format, /stats.json as JSON.
+    Snapshots are taken when scraped, so emit() has nothing to do.
+    """
+    def __init__(self, registry=REGISTRY, port=9108, host="127.0.0.1"):
+        self.registry = registry
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = prometheus_text(sink.registry.snapshot()).encode("utf-8")
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/stats.json":
+                    body = json.dumps(sink.registry.snapshot()).encode("utf-8")
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # One line per scrape would drown the console
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def emit(self, snapshot):
+        pass
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class MetricsReporter:
+    """
+    Pushes a snapshot of the registry to each sink every `interval` seconds, from its own thread.
+    """
+    def __init__(self, sinks, interval=DEFAULT_REPORT_INTERVAL, registry=REGISTRY):
+        self.sinks = sinks
+        self.interval = interval
+        self.registry = registry
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
+
+    def report(self):
+        snapshot = self.registry.snapshot()
+        for sink in self.sinks:
+            try:
+                sink.emit(snapshot)
+            except Exception as e:
+                print(f"[WARN] Metrics sink {type(sink).__name__} failed: {e}", file=sys.stderr)
+
+    def stop(self):
+        self.stop_event.set()
+        for sink in self.sinks:
+            if hasattr(sink, "close"):
+                sink.close()
+
+# --- Profiling ---
+class LoopProfiler:
+    """
+    cProfile capture of a running loop, on demand.
+    request() may be called from any thread; the loop calls tick() once per iteration, which
+    starts the profiler on the loop's own thread (cProfile only sees the thread that enables it)
+    and writes the stats to the requested file once the time is up. Costs one attribute
+    check per iteration while idle.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.pending = None # (seconds, path) requested, not yet started
+        self.profile = None
+        self.deadline = 0.0
+        self.path = None
+
+    def request(self, seconds, path=None):
+        self.pending = (seconds, path or f"profile-{self.name}-{time.strftime('%Y%m%d-%H%M%S')}.prof")
+
+    def tick(self):
+        if self.profile is not None:
+            if time.monotonic() >= self.deadline:
+                self._finish()
+            return
+        if self.pending is not None:
+            seconds, self.path = self.pending
+            self.pending = None
+            self.deadline = time.monotonic() + seconds
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            print(f"[INFO] Profiling {self.name} loop for {seconds}s...")
+
+    def _finish(self):
+        self.profile.disable()
+        self.profile.dump_stats(self.path)
+        stats = pstats.Stats(self.profile)
+        stats.sort_stats("cumulative").print_stats(15)
+        self.profile = None
+        print(f"[INFO] Profile of {self.name} loop saved to {self.path}.")
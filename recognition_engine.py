@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import math
+import time
+import argparse
+from collections import namedtuple
+import cv2
+import face_recognition
+
+import metrics
+from face_matcher import FaceMatcher
+from face_tracker import FaceTracker
+from detection_policy import DetectionPolicy
+from gallery_store import DEFAULT_GALLERY_FILE, LEGACY_PICKLE_FILE, load_gallery, migrate_legacy_pickle
+from frame_sources import iter_frames
+
+# box is (top, right, bottom, left) in full-frame pixels
+RecognitionEvent = namedtuple("RecognitionEvent", ["identity", "distance", "timestamp", "box", "track_id"])
+
+def detect_faces(frame, plan):
+    """
+    Runs face detection on the regions of a DetectionPlan.
+    Returns the boxes in full-frame coordinates and, per box, the (RGB image, location)
+    to embed it from.
+    """
+    boxes = []
+    crops = []
+    for region in plan.regions:
+        top, right, bottom, left = region
+        crop = frame[top:bottom, left:right]
+        if plan.scale != 1.0:
+            # Resize for faster processing
+            crop = cv2.resize(crop, (0, 0), fx=plan.scale, fy=plan.scale)
+        rgb_crop = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB) # face_recognition uses RGB
+
+        for location in face_recognition.face_locations(rgb_crop):
+            t, r, b, l = (int(v / plan.scale) for v in location)
+            boxes.append((top + t, left + r, top + b, left + l))
+            crops.append((rgb_crop, location))
+    return boxes, crops
+
+def embed_faces(crops):
+    # One encoding per (image, location) from detect_faces
+    face_encodings = []
+    for image, location in crops:
+        face_encodings.extend(face_recognition.face_encodings(image, [location]))
+    return face_encodings
+
+def load_matcher(encodings_file=DEFAULT_GALLERY_FILE, migrate=True):
+    # migrate=False for worker processes: the parent has already imported any old pickle
+    if migrate:
+        migrate_legacy_pickle(LEGACY_PICKLE_FILE, encodings_file)
+    if os.path.exists(encodings_file):
+        print("[INFO] Loading encodings...", file=sys.stderr)
+        # Memory-mapped: no copy of the gallery is made, whatever its size
+        return FaceMatcher.from_gallery(load_gallery(encodings_file))
+    print("[WARN] No encodings file found.", file=sys.stderr)
+    return FaceMatcher([], [])
+
+class RecognitionEngine:
+    """
+    Detection, tracking and matching over plain BGR frames.
+    Has no display or GUI dependencies, so it can run on a headless box;
+    CameraService drives one of these for the kiosk.
+    """
+    def __init__(self, encodings_file=DEFAULT_GALLERY_FILE, matcher=None):
+        # matcher: an already loaded FaceMatcher to share (e.g. between cameras) instead of loading one
+        self.encodings_file = encodings_file
+
+        # Decides where and at what scale detection runs; tracks carry faces between detections
+        self.detection_policy = DetectionPolicy()
+        self.tracker = FaceTracker()
+        self.detect_next = True
+        self.tracks_stale = False
+        self.last_events = []
+
+        self.matcher = FaceMatcher([], [])
+        if matcher is not None:
+            self.set_matcher(matcher)
+        else:
+            self.load_encodings()
+
+    def load_encodings(self):
+        self.set_matcher(load_matcher(self.encodings_file))
+
+    def set_matcher(self, matcher):
+        # Single reference swap so the recognition thread never sees a half-built gallery
+        self.matcher = matcher
+        # Votes were cast against the old gallery
+        self.reset()
+
+    def reset(self):
+        # Applied on the next process() call, on the thread doing the recognition
+        self.tracks_stale = True
+
+    def process(self, frame, timestamp=None):
+        """
+        Runs recognition on one frame. Returns a RecognitionEvent per tracked face,
+        or None when the frame was skipped (nothing changed since the last one).
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if self.tracks_stale:
+            self.tracks_stale = False
+            self.tracker.reset()
+            self.last_events = []
+
+        # Faces mostly stand still: the policy skips static frames and only scans
+        # changed regions and the areas around existing tracks between full scans
+        track_boxes = [track.box for track in self.tracker.tracks]
+        plan = self.detection_policy.plan(frame, track_boxes, force_full=self.detect_next)
+        if plan is None:
+            metrics.counter("recognition.skipped_frames").inc()
+            return None
+
+        started = time.perf_counter()
+        boxes, crops = detect_faces(frame, plan)
+        detect_seconds = time.perf_counter() - started
+        self.detection_policy.record_detection(detect_seconds)
+        metrics.timer("recognition.detect").observe(detect_seconds)
+        self.detection_policy.observe(boxes)
+
+        tracks, changed = self.tracker.update(boxes, None if plan.full else plan.regions)
+        self.detect_next = changed
+
+        # Only new faces and faces whose identity confidence decayed are re-embedded
+        stale = [i for i, track in enumerate(tracks) if self.tracker.needs_embedding(track)]
+        if stale:
+            with metrics.timer("recognition.embed").time():
+                face_encodings = embed_faces([crops[i] for i in stale])
+
+            # Score every face against the whole gallery in one batch
+            with metrics.timer("recognition.match").time():
+                matches = self.matcher.match(face_encodings)
+            for i, match in zip(stale, matches):
+                tracks[i].add_observation(match)
+
+        self.last_events = [
+            RecognitionEvent(track.identity, track.distance, timestamp, track.box, track.id)
+            for track in tracks
+        ]
+        return self.last_events
+
+    def run(self, source, callback, mirror=False, max_frames=None):
+        """
+        Feeds every frame of a source (see frame_sources.iter_frames) through process()
+        and calls callback(event) for each recognition.
+        """
+        for count, (timestamp, frame) in enumerate(iter_frames(source, mirror=mirror)):
+            if max_frames is not None and count >= max_frames:
+                break
+            for event in self.process(frame, timestamp) or []:
+                callback(event)
+
+def event_to_json(event, source=None):
+    record = {
+        "identity": event.identity,
+        # No gallery gives an infinite distance, which JSON cannot represent
+        "distance": round(event.distance, 4) if event.distance is not None and math.isfinite(event.distance) else None,
+        "timestamp": round(event.timestamp, 3),
+        "box": list(event.box),
+        "track_id": event.track_id,
+    }
+    if source is not None:
+        record["source"] = str(source)
+    return json.dumps(record)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run face recognition without the GUI and print events as JSON lines.")
+    parser.add_argument("source", help="webcam index, video file, stream URL or image directory")
+    parser.add_argument("--gallery", default=DEFAULT_GALLERY_FILE, help="gallery file to match against")
+    parser.add_argument("--output", default="-", help="JSON lines file to write ('-' for stdout)")
+    parser.add_argument("--mirror", action="store_true", help="flip frames horizontally like the kiosk does")
+    parser.add_argument("--max-frames", type=int, default=None, help="stop after this many frames")
+    args = parser.parse_args()
+
+    engine = RecognitionEngine(args.gallery)
+    out = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        engine.run(args.source, lambda event: print(event_to_json(event, args.source), file=out, flush=True),
+                   mirror=args.mirror, max_frames=args.max_frames)
+    finally:
+        if out is not sys.stdout:
+            out.close()
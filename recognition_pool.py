@@ -0,0 +1,235 @@
+import os
+import sys
+import time
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+
+import metrics
+from face_matcher import FaceMatcher
+from face_tracker import FaceTracker, iou
+from detection_policy import DetectionPolicy
+from gallery_store import DEFAULT_GALLERY_FILE, load_gallery
+from recognition_engine import RecognitionEvent, detect_faces, embed_faces
+
+# Frames that can be in flight per worker: one being processed, one waiting
+SLOTS_PER_WORKER = 2
+
+class FrameRing:
+    """
+    Fixed-size frame buffers in one shared memory block, so worker processes read frames
+    in place instead of receiving pickled copies.
+    """
+    def __init__(self, slots, shape, dtype=np.uint8, name=None):
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.frame_bytes * slots)
+        else:
+            # Workers share the owner's resource tracker, so attaching does not hand them the cleanup
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.buffer = np.ndarray((slots,) + self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def frame(self, slot):
+        return self.buffer[slot]
+
+    def close(self):
+        self.buffer = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+# --- Worker process side ---
+_ring = None
+_matcher = None
+_gallery_version = None
+_gallery_file = None
+
+def _init_worker(ring_name, slots, shape, gallery_file):
+    global _ring, _gallery_file
+    _ring = FrameRing(slots, shape, name=ring_name)
+    _gallery_file = gallery_file
+
+def _load_matcher(version):
+    # The gallery is loaded once per worker and again only when the app retrains
+    global _matcher, _gallery_version
+    if version != _gallery_version:
+        if os.path.exists(_gallery_file):
+            _matcher = FaceMatcher.from_gallery(load_gallery(_gallery_file))
+        else:
+            _matcher = FaceMatcher([], [])
+        _gallery_version = version
+    return _matcher
+
+def _recognize_slot(slot, seq, plan, known_boxes, gallery_version, iou_threshold):
+    """
+    Detects faces in one frame of the ring and matches those not already known.
+    Returns (seq, [(box, Match or None)], detect_seconds); Match is None for faces that
+    overlap a confidently identified track and were not embedded.
+    """
+    matcher = _load_matcher(gallery_version)
+    started = time.perf_counter()
+    boxes, crops = detect_faces(_ring.frame(slot), plan)
+    detect_seconds = time.perf_counter() - started
+
+    todo = [i for i, box in enumerate(boxes)
+            if not any(iou(box, known) >= iou_threshold for known in known_boxes)]
+    matches = [None] * len(boxes)
+    if todo:
+        for i, match in zip(todo, matcher.match(embed_faces([crops[i] for i in todo]))):
+            matches[i] = match
+    return seq, list(zip(boxes, matches)), detect_seconds
+
+# --- Parent process side ---
+class RecognitionPool:
+    """
+    Recognition spread over worker processes, for cameras where one core cannot keep up.
+    Frames are copied into a FrameRing; workers run detection, embedding and matching
+    on them in place and send back only boxes and matches. Tracking and the detection
+    policy stay in this process, and results are applied in frame order; a result that
+    arrives after a newer one has been applied is dropped.
+    """
+    def __init__(self, encodings_file=DEFAULT_GALLERY_FILE, workers=2, slots=None, callback=None):
+        self.encodings_file = encodings_file
+        self.workers = workers
+        self.slot_count = slots or workers * SLOTS_PER_WORKER
+        self.callback = callback # callback(events) for every applied result
+
+        self.detection_policy = DetectionPolicy()
+        self.tracker = FaceTracker()
+        self.detect_next = True
+        self.last_events = []
+
+        self.lock = threading.Lock()
+        self.ring = None
+        self.executor = None
+        self.free_slots = []
+        self.seq = 0
+        self.applied_seq = 0
+        self.gallery_version = 0
+
+        metrics.gauge("pool.slots_in_use", lambda: self.slot_count - len(self.free_slots) if self.ring else 0)
+
+    def _start(self, shape):
+        # The ring is sized for the camera's frames, so it is created with the first one
+        self.ring = FrameRing(self.slot_count, shape)
+        self.free_slots = list(range(self.slot_count))
+        # spawn, not fork: this process runs Tk and several threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.ring.name, self.slot_count, shape, self.encodings_file),
+        )
+        # Processes start one per submitted job; start them all now, each loading the gallery,
+        # rather than while the first faces are waiting
+        for _ in range(self.workers):
+            self.executor.submit(_load_matcher, self.gallery_version)
+        print(f"[INFO] Started {self.workers} recognition worker(s).", file=sys.stderr)
+
+    def submit(self, frame, timestamp=None):
+        """
+        Hands a frame to the workers without waiting for the result.
+        Returns False when the frame was not sent: nothing changed since the last one,
+        or every buffer is still in use (the frame is dropped).
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if self.ring is not None and frame.shape != self.ring.shape:
+            self.close()
+        if self.ring is None:
+            self._start(frame.shape)
+
+        with self.lock:
+            track_boxes = [track.box for track in self.tracker.tracks]
+            known_boxes = [track.box for track in self.tracker.tracks if not self.tracker.needs_embedding(track)]
+            plan = self.detection_policy.plan(frame, track_boxes, force_full=self.detect_next)
+            if plan is None:
+                metrics.counter("recognition.skipped_frames").inc()
+                return False
+            if not self.free_slots:
+                metrics.counter("pool.dropped_frames").inc()
+                return False
+            slot = self.free_slots.pop()
+            self.seq += 1
+            seq = self.seq
+
+        np.copyto(self.ring.frame(slot), frame)
+        try:
+            future = self.executor.submit(_recognize_slot, slot, seq, plan, known_boxes,
+                                          self.gallery_version, self.tracker.iou_threshold)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a fresh pool with the next frame
+            print("[WARN] Recognition workers stopped unexpectedly, restarting.", file=sys.stderr)
+            self.close()
+            return False
+        future.add_done_callback(lambda f: self._done(f, slot, plan, timestamp))
+        return True
+
+    def _done(self, future, slot, plan, timestamp):
+        # Runs on the executor's result thread
+        with self.lock:
+            self.free_slots.append(slot)
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            print(f"[WARN] Recognition worker failed: {error}", file=sys.stderr)
+            return
+        seq, faces, detect_seconds = future.result()
+
+        with self.lock:
+            if seq <= self.applied_seq:
+                metrics.counter("pool.late_results").inc()
+                return
+            self.applied_seq = seq
+
+            boxes = [box for box, _ in faces]
+            self.detection_policy.record_detection(detect_seconds)
+            metrics.timer("recognition.detect").observe(detect_seconds)
+            self.detection_policy.observe(boxes)
+
+            tracks, changed = self.tracker.update(boxes, None if plan.full else plan.regions)
+            self.detect_next = changed
+            for track, (_, match) in zip(tracks, faces):
+                # A face the worker skipped as known gets embedded on a later frame if it is still needed
+                if match is not None and self.tracker.needs_embedding(track):
+                    track.add_observation(match)
+
+            self.last_events = events = [
+                RecognitionEvent(track.identity, track.distance, timestamp, track.box, track.id)
+                for track in tracks
+            ]
+        if self.callback:
+            self.callback(events)
+
+    def reset(self):
+        # Drops the tracks and every result still in flight
+        with self.lock:
+            self.tracker.reset()
+            self.last_events = []
+            self.detect_next = True
+            self.applied_seq = self.seq
+
+    def reload_gallery(self):
+        # Workers load the gallery again before their next frame
+        self.gallery_version += 1
+        self.reset()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
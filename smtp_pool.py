@@ -0,0 +1,187 @@
+import time
+import queue
+import smtplib
+import threading
+from concurrent.futures import Future
+
+import metrics
+
+class TokenBucket:
+    """
+    Allows `rate` operations per second on average, with bursts of up to `burst`.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def _is_permanent(error):
+    # 5xx replies (bad address, message rejected) will not succeed on a retry
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    code = getattr(error, "smtp_code", None)
+    return code is not None and 500 <= code < 600
+
+class SmtpDeliveryPool:
+    """
+    Sends email over a few long-lived, authenticated SMTP connections.
+    Each worker thread owns one connection and sends many messages over it, so the
+    TCP/STARTTLS/login handshake is paid once per connection instead of once per message.
+    Sending is rate limited with a shared token bucket and transient failures are
+    retried with exponential backoff. A rejected login stops the pool: every message
+    fails at once, without logging in again, until set_credentials() is called, so wrong
+    credentials cannot get the account locked for too many failed logins.
+    """
+    def __init__(self, host, port, username=None, password=None, use_tls=True,
+                 connections=3, rate_per_second=5.0, burst=10, max_retries=3,
+                 backoff=1.0, max_backoff=30.0, messages_per_connection=100,
+                 idle_timeout=30.0, timeout=30.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.connections = connections
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.messages_per_connection = messages_per_connection
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self.bucket = TokenBucket(rate_per_second, burst)
+        self.queue = queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+        self.closed = False
+        self.auth_error = None # The server's rejection of the current credentials, if any
+        metrics.gauge("smtp.queue_depth", self.queue.qsize)
+
+    def submit(self, message):
+        """
+        Queues an email.message.Message for delivery. Returns a Future that resolves
+        once the message was accepted by the server (or failed for good).
+        """
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("SmtpDeliveryPool is closed")
+            if self.auth_error is not None:
+                future.set_exception(self.auth_error)
+                return future
+            # Workers start on first use so an idle app holds no connections
+            if len(self.workers) < self.connections:
+                worker = threading.Thread(target=self._worker_loop, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+        self.queue.put((message, future))
+        return future
+
+    def send_many(self, messages):
+        return [self.submit(message) for message in messages]
+
+    def set_credentials(self, username, password):
+        # New credentials; connections log in again from the next message on
+        with self.lock:
+            self.username = username
+            self.password = password
+            self.auth_error = None
+
+    def close(self, wait=True):
+        with self.lock:
+            self.closed = True
+            workers = list(self.workers)
+        for _ in workers:
+            self.queue.put(None)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            server.starttls()
+        if self.username:
+            server.login(self.username, self.password)
+        return server
+
+    def _disconnect(self, server):
+        if server is None:
+            return
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def _worker_loop(self):
+        server = None
+        sent_on_connection = 0
+        while True:
+            try:
+                item = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                # Servers drop idle sessions anyway; close ours first
+                self._disconnect(server)
+                server = None
+                continue
+            if item is None:
+                break
+
+            message, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            if self.auth_error is not None:
+                # Queued before the login was rejected; fail it without trying to log in again
+                future.set_exception(self.auth_error)
+                continue
+
+            attempt = 0
+            while True:
+                try:
+                    if server is None or sent_on_connection >= self.messages_per_connection:
+                        self._disconnect(server)
+                        server = self._connect()
+                        sent_on_connection = 0
+                    self.bucket.acquire()
+                    with metrics.timer("smtp.send").time():
+                        server.send_message(message)
+                    sent_on_connection += 1
+                    future.set_result(message["To"])
+                    break
+                except smtplib.SMTPAuthenticationError as e:
+                    self._disconnect(server)
+                    server = None
+                    metrics.counter("smtp.errors").inc()
+                    with self.lock:
+                        first = self.auth_error is None
+                        self.auth_error = e
+                    if first:
+                        print(f"[WARN] SMTP login rejected ({e.smtp_code}); no email is sent until the credentials are changed.")
+                    future.set_exception(e)
+                    break
+                except (smtplib.SMTPException, OSError) as e:
+                    # The connection state is unknown after an error; start the next try on a fresh one
+                    self._disconnect(server)
+                    server = None
+                    attempt += 1
+                    metrics.counter("smtp.errors").inc()
+                    if _is_permanent(e) or attempt > self.max_retries:
+                        future.set_exception(e)
+                        break
+                    time.sleep(min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+        self._disconnect(server)
@@ -0,0 +1,65 @@
+import threading
+from collections import namedtuple
+
+# Same column order as the users table, so User(*row) works on a fetched row
+User = namedtuple("User", ["id", "name", "role", "email_student", "email_parent"])
+
+class UserDirectory:
+    """
+    In-memory copy of the users table keyed by ID.
+    Loaded once and kept current by DatabaseManager.add_user/delete_user, so
+    lookups on the recognition path never touch SQLite. Changes made by other
+    connections or processes are picked up by refresh_if_changed().
+    """
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.users = {}
+        self.data_versions = {} # {thread id: PRAGMA data_version seen at the last load}
+        self.reload()
+
+    def reload(self):
+        rows = self.db.get_all_users()
+        users = {str(row[0]): User(*row) for row in rows}
+        with self.lock:
+            self.users = users
+            self.data_versions = {threading.get_ident(): self._data_version()}
+
+    def refresh_if_changed(self):
+        # data_version is per connection (one per thread) and moves when another connection commits
+        version = self._data_version()
+        with self.lock:
+            seen = self.data_versions.get(threading.get_ident())
+            self.data_versions[threading.get_ident()] = version
+        if seen is not None and seen != version:
+            self.reload()
+            return True
+        return False
+
+    def _data_version(self):
+        return self.db._conn().execute("PRAGMA data_version").fetchone()[0]
+
+    def get(self, user_id):
+        return self.users.get(str(user_id))
+
+    def role_of(self, user_id):
+        user = self.users.get(str(user_id))
+        return user.role if user else None
+
+    def all(self):
+        return sorted(self.users.values(), key=lambda u: u.id)
+
+    def students(self):
+        return [u for u in self.all() if u.role == "Student"]
+
+    def put(self, user):
+        with self.lock:
+            users = dict(self.users)
+            users[str(user.id)] = user
+            self.users = users
+
+    def remove(self, user_id):
+        with self.lock:
+            users = dict(self.users)
+            users.pop(str(user_id), None)
+            self.users = users
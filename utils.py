@@ -1,19 +1,186 @@
 import os
-import pyttsx3
+import time
+import heapq
+import shutil
 import threading
 
+import metrics
+
 def create_directory(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
-def speak(text):
+def remove_directory(path):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+def join_names(names):
+    # ["A", "B", "C"] -> "A, B and C"
+    if len(names) < 2:
+        return "".join(names)
+    return f"{', '.join(names[:-1])} and {names[-1]}"
+
+# Speech priorities; lower is more urgent
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+SPEECH_QUEUE_SIZE = 8   # Announcements waiting at most; the least urgent are dropped beyond this
+SPEECH_MAX_AGE = 5.0    # Seconds after which an announcement not yet spoken is dropped
+SPEECH_MAX_NAMES = 5    # Names merged into one announcement
+
+class RecordingBackend:
+    """
+    Speaks nothing and keeps what would have been said, for headless and test runs.
+    """
+    def __init__(self):
+        self.spoken = []
+
+    def say(self, text):
+        self.spoken.append(text)
+
+class NullBackend:
+    """
+    Speaks nothing and keeps nothing; used when the speech driver fails.
+    """
+    def say(self, text):
+        pass
+
+class Pyttsx3Backend:
+    """
+    Speaks through one pyttsx3 engine, created on first use in the speech thread.
+    """
+    def __init__(self):
+        self.engine = None
+
+    def say(self, text):
+        if self.engine is None:
+            import pyttsx3 # Imported here so tools that never speak don't need a speech driver
+            self.engine = pyttsx3.init()
+        self.engine.say(text)
+        self.engine.runAndWait()
+
+class _Announcement:
+    def __init__(self, text, template, names, deadline):
+        self.text = text
+        self.template = template
+        self.names = names
+        self.deadline = deadline
+
+    def render(self):
+        if self.template is None:
+            return self.text
+        return self.template.format(names=join_names(self.names))
+
+class SpeechService:
+    """
+    One background thread that owns the speech engine and speaks queued announcements
+    one at a time, most urgent first. Announcements that waited longer than max_age are
+    dropped, and name announcements still waiting are merged ("Welcome A, B and C"),
+    so a burst of arrivals is announced once and never falls minutes behind.
+    """
+    def __init__(self, backend=None, max_queue=SPEECH_QUEUE_SIZE, max_age=SPEECH_MAX_AGE, max_names=SPEECH_MAX_NAMES):
+        self.backend = backend or Pyttsx3Backend()
+        self.max_queue = max_queue
+        self.max_age = max_age
+        self.max_names = max_names
+
+        self.queue = [] # heap of (priority, sequence, _Announcement)
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.thread = None
+        metrics.gauge("speech.queue_depth", lambda: len(self.queue))
+        metrics.gauge("speech.dropped", lambda: self.dropped)
+
+    def say(self, text, priority=PRIORITY_NORMAL):
+        self._put(priority, _Announcement(text, None, None, time.monotonic() + self.max_age))
+
+    def say_names(self, template, name, priority=PRIORITY_NORMAL):
+        """
+        Announces template.format(names=...) for name, e.g. say_names("Welcome {names}", "Ann").
+        Joins a waiting announcement with the same template instead of queueing another one.
+        """
+        with self.condition:
+            for _, _, announcement in self.queue:
+                if announcement.template == template and len(announcement.names) < self.max_names:
+                    if name not in announcement.names:
+                        announcement.names.append(name)
+                    announcement.deadline = time.monotonic() + self.max_age
+                    return
+            # Still under the (reentrant) lock, so a concurrent call merges into this one
+            self._put(priority, _Announcement(None, template, [name], time.monotonic() + self.max_age))
+
+    def _put(self, priority, announcement):
+        with self.condition:
+            if self.closed:
+                return
+            if len(self.queue) >= self.max_queue:
+                # Make room by dropping the least urgent, oldest announcement, unless the new one is less urgent still
+                worst = max(self.queue, key=lambda entry: (entry[0], -entry[1]))
+                self.dropped += 1
+                if priority > worst[0]:
+                    return
+                self.queue.remove(worst)
+                heapq.heapify(self.queue)
+            self.sequence += 1
+            heapq.heappush(self.queue, (priority, self.sequence, announcement))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def close(self, wait=False):
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.condition.notify()
+        if wait and self.thread is not None:
+            self.thread.join()
+
+    def pending(self):
+        with self.condition:
+            return [announcement.render() for _, _, announcement in sorted(self.queue)]
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                _, _, announcement = heapq.heappop(self.queue)
+
+            if time.monotonic() > announcement.deadline:
+                self.dropped += 1
+                continue
+            try:
+                self.backend.say(announcement.render())
+            except Exception as e:
+                # e.g. no speech driver on this machine; keep the app running silently
+                print(f"[WARN] Speech unavailable ({e}); announcements will not be spoken.")
+                self.backend = NullBackend()
+
+_speech_service = None
+_speech_lock = threading.Lock()
+
+def get_speech_service():
+    global _speech_service
+    with _speech_lock:
+        if _speech_service is None:
+            _speech_service = SpeechService()
+        return _speech_service
+
+def set_speech_service(service):
+    # E.g. set_speech_service(SpeechService(RecordingBackend())) for headless runs
+    global _speech_service
+    with _speech_lock:
+        _speech_service = service
+
+def speak(text, priority=PRIORITY_NORMAL):
     """
-    Uses pyttsx3 to speak the text.
-    Runs in a separate thread to avoid blocking the UI.
+    Queues text on the shared speech service.
+    Returns immediately; the speech thread says it when its turn comes.
     """
-    def _speak_thread():
-        engine = pyttsx3.init()
-        engine.say(text)
-        engine.runAndWait()
-    
-    threading.Thread(target=_speak_thread, daemon=True).start()
+    get_speech_service().say(text, priority)